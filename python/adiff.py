@@ -15,6 +15,31 @@
 #                 add progress counters
 # 06/06/16: (jhj) fixed temp.dfxml parsing bug: some entries have two data blocks, so
 #                     look for original_fileobject tag before processing
+# 10/18/26: added process pool for hashing subsequent images (NUM_WORKERS);
+#           images are split into offset ranges and hashed side by side
+# 10/18/26: added read planner: sectors are sorted, coalesced into runs and read
+#           through mmap (or one large read per run), hashed from memoryview slices
+#           (the image is mapped once by find_deleted and once per task, not per byte run)
+# 10/18/26: deleted.db is created from python (table + indexes, WAL, tuned pragmas);
+#           rows are written with executemany in DB_BATCH_SIZE transactions
+# 10/18/26: normalized deleted.db schema: images and files lookup tables referenced by
+#           integer ids, binary digests (DIGEST_FORMAT); see migrate_db.py for old DBs
+# 10/18/26: added incremental runs (INCREMENTAL): processed images are recorded with size,
+#           mtime and checksum, and only images added to IMAGE_LIST since the last run are hashed
+# 10/18/26: replaced line/string-split DFXML parsing with a streaming iterparse parser
+#           (iter_deleted_files) that runs in its own thread ahead of sector hashing
+# 10/18/26: added threaded pipeline for subsequent images (PIPELINE): reader threads, hasher
+#           threads and one DB writer connected by bounded queues
+#           (one hasher thread by default unless sectors are 2048+ bytes; see HASHER_THREADS)
+# 10/18/26: added sector fingerprint backends (FINGERPRINT: md5, blake2b, xxhash, crc, compare),
+#           recorded in the db meta table, and optional exact-match verification (VERIFY_MATCHES)
+# 10/18/26: added early termination (EARLY_TERMINATION): sector_state records the first image where
+#           each sector changed, and later images only read and store sectors that are still intact
+# 10/18/26: FINGERPRINT='compare' and VERIFY_MATCHES compare against base image sectors cached in
+#           deleted.db (base_sectors) by find_deleted, instead of re-reading the base image for every image
+# 10/18/26: replaced per-sector progress prints with rate-limited progress (throughput, ETA);
+#           added per-stage timers, JSON-lines metrics (METRICS_FILE) and cProfile dumps (PROFILE_FILE)
+# 10/18/26: read and hash are timed separately in every path; mmap runs are paged in before hashing
 
 # for debugging
 #import pdb
@@ -24,15 +49,54 @@
 import os
 import sys
 import hashlib
+import zlib
+import mmap
 import sqlite3
-import binascii
+import multiprocessing
+import threading
+import queue
+import collections
+import xml.etree.ElementTree as ET
+import time
 from datetime import datetime
+try:
+    import xxhash # optional; only needed for FINGERPRINT='xxhash'
+except ImportError:
+    xxhash = None
+import progress
 
 ### User-set vars...
 IDIFF2_PATH='/path_to/dfxml/python/idifference2.py'
 SECTOR_SIZE=512 # 512,4096,... use image drive sector size
 IMAGE_LIST=['image0.img','image1.img',...] # python list of image files; order matters
 HAVE_TEMP_DFXML=True # True if you already have a temp.dfxml file (idiff output for images 1-2), otherwise False; saves time
+NUM_WORKERS=(os.cpu_count() or 1) # number of hashing processes for subsequent images; 1 hashes one image at a time in this process
+RANGE_SIZE=1024*1024*1024 # bytes of image offset space handed to a worker at a time (splits large images across workers)
+BATCH_SIZE=10000 # max sectors per worker task; each task returns one batch of rows to the DB writer
+MAX_GAP=64*1024 # bytes of untracked data read through to merge two neighbouring sector runs into one read
+MAX_RUN=8*1024*1024 # max bytes in one coalesced read
+USE_MMAP=True # read runs through mmap; set to False for one buffered read per run (falls back automatically if mmap fails)
+DB_BATCH_SIZE=50000 # rows per executemany/commit when writing deleted.db
+DB_SYNCHRONOUS='NORMAL' # sqlite synchronous pragma (OFF, NORMAL, FULL); NORMAL is safe with WAL journaling
+DB_CACHE_SIZE=-262144 # sqlite cache_size pragma; negative values are KiB (-262144 = 256MB)
+DIGEST_FORMAT='blob' # 'blob' stores the 16-byte md5 digest; 'int64' stores its first 8 bytes as an integer (smaller DB)
+FINGERPRINT='md5' # sector fingerprint: 'md5'; 'blake2b' (8-byte digest); 'xxhash' (xxh64, needs the xxhash package);
+                  # 'crc' (crc32+adler32, 8 bytes); 'compare' (byte comparison with the base image sector, stored as 0/1)
+                  # 'compare' and VERIFY_MATCHES keep a copy of the tracked base image sectors in deleted.db (base_sectors)
+EARLY_TERMINATION=False # True stops reading/storing a sector in later images once it has changed (images are then hashed one at a time)
+VERIFY_MATCHES=False # True re-checks sectors whose fingerprint matches the base image by comparing the bytes; mismatches are stored as changed
+INCREMENTAL=False # True adds only images appended to IMAGE_LIST since the last run to deleted.db; False rebuilds deleted.db
+CHECKSUM_BYTES=16*1024*1024 # bytes from the start and end of each image hashed into its recorded checksum; 0 hashes the whole image
+PARSE_AHEAD=1000 # deleted files the DFXML parser thread may get ahead of base image hashing
+PIPELINE=False # True hashes subsequent images with reader threads, hasher threads and one DB writer (instead of NUM_WORKERS processes)
+READER_THREADS=2 # pipeline threads reading coalesced runs from the images
+HASHER_THREADS=None # pipeline threads hashing sectors; None uses 1 for sectors under 2048 bytes (hashlib holds the GIL, so more
+                    # threads only contend) and one per CPU for 4K sectors (hashlib releases the GIL for 2048+ bytes)
+QUEUE_DEPTH=16 # max runs (of up to MAX_RUN bytes) or hashed batches waiting between pipeline stages;
+               # also the pool tasks queued beyond NUM_WORKERS, so finished batches never pile up ahead of the DB writer
+PROGRESS_INTERVAL=1.0 # seconds between progress line updates
+METRICS_FILE=None # file to append JSON-lines metrics to (progress, stage times), e.g. 'adiff_metrics.jsonl'; None disables
+PROFILE_FILE=None # file to write a cProfile dump of the main process to, e.g. 'adiff.prof'; None disables
 ### end User-set vars
 
 def find_deleted(i1,i2):
@@ -42,116 +106,637 @@ def find_deleted(i1,i2):
         cmd='python3 '+IDIFF2_PATH+' -x temp.dfxml '+i1+' '+i2
         print('Running: '+cmd)
         os.system(cmd)
-    ### parse dfxml for deleted files and byte runs; put into sqlite db
-    # FYI, db schema:
-    #   CREATE TABLE deleted_files(
-    #     img TEXT,
-    #     filename TEXT,
-    #     resident BOOLEAN,
-    #     offset INTEGER,
-    #     frags INTEGER,
-    #     md5 TEXT);
+    ### parse dfxml for deleted files and byte runs; put into sqlite db (see create_db() for the schema)
     # open db
-    conn_c = sqlite3.connect("deleted.db")
-    c = conn_c.cursor()
-    # crude (but fast?) method follows; comment out if better method is implemented (XTREE?)
-    counter = 0
-    img = i1 # set image identifier
+    conn_c = open_db()
     f_img = open(i1,'rb') # open image file for subsequent sector hashing
-    with open('temp.dfxml','r') as fi:
-        print('Processing files in temp.dfxml (NOTE: 0 size files are counted but not loaded into DB):')
-        for line in fi:
-            if 'delta:deleted_file="1"' in line: # process a deleted file line (one element in the DFXML file)
-                counter+=1 # this and next line to show processing progress
-                print(str(counter)+'\r',end="")
-                if('type="resident"' in line):
-                    resident = True
-                else:
-                    resident = False
-                frags=0 # initialize
-                ready_to_parse = False
-                for item in line.split("<"):
-                    if 'delta:original_fileobject' in item:
-                        ready_to_parse = True
-                        continue
-                    if ready_to_parse:
-                        if ('img_offset="' in item):
-                            frags+=1
-                        if ("filename>" in item) and ("/filename" not in item):
-                            filename = item [ len("filename>") : ]
-                        if ("byte_run" in item) and ("byte_runs" not in item) and ("byte_run_" not in item): # won't write to DB if no byte_run (prob size=0)
-                            item_values = item.split('"')
-                            if (item_values[2] == ' fill=') and (item_values[3] == '0'): # byte_run of all zeros not worth tracking
-                                break # breaks out of the "for item" loop
-                            if ((item_values[0] == 'byte_run file_offset=') and (item_values[2] == ' uncompressed_len=')): # continuation byte_run
-                                file_offset = int(item_values[1])
-                                offset = saved_img_offset + file_offset
-                                length = int(item_values[3])
-                            else:
-                                offset = int(item_values[5]) # "img_offset" value in the DFXML file
-                                length = int(item_values[7]) # "uncompressed_len" value in the DFXML file
-                                saved_img_offset = offset # save the base offset for continuation byte_run(s)
-                            md5 = compute_sector_md5(f_img,offset) # params are an open file handle and offset in bytes
-                            insert_values = (img,filename,resident,offset,frags,md5)
-                            c.execute('INSERT into deleted_files VALUES (?,?,?,?,?,?)', insert_values)
-                            length = length - SECTOR_SIZE # will be greater than 0 if more than one sector in this byte run
-                            while length > 0:
-                                offset = offset+SECTOR_SIZE
-                                md5 = compute_sector_md5(f_img,offset)
-                                insert_values = (img,filename,resident,offset,frags,md5)
-                                c.execute('INSERT into deleted_files VALUES (?,?,?,?,?,?)', insert_values)
-                                length = length - SECTOR_SIZE # will still be greater than 0 if more sectors in this byte run
+    mm = map_image(f_img) # mapped once and read by every byte run
+    insert_rows(conn_c,deleted_sectors(conn_c,IMAGE_LIST.index(i1),f_img,mm))
+    if needs_base_sectors():
+        conn_c.execute("INSERT OR REPLACE INTO meta VALUES ('base_sectors','1');")
+        conn_c.commit()
     # close db and img file
-    conn_c.commit()
     conn_c.close()
+    if mm is not None:
+        mm.close()
     f_img.close()
     print('\n')
 
-def compute_sector_md5(fh,offset):
-    fh.seek(offset) # seek takes bytes
-    sector_contents = fh.read(SECTOR_SIZE) # assumes read returns binary (bytes object)
-    r = hashlib.md5(sector_contents).digest()
-    r_string = (str(binascii.b2a_hex(r)))[2:-1]
-    return r_string
+def deleted_sectors(conn_c,img_id,f_img,mm=None):
+    # adds each deleted file in temp.dfxml to the files table and yields one sectors row per
+    # sector hashed from the open base image (read through mm, its map_image(), if not None);
+    # the DFXML is parsed in a separate thread
+    print('Processing files in temp.dfxml (NOTE: 0 size files are counted but not loaded into DB):')
+    files_progress = progress.Progress('Deleted files',unit='files')
+    for filename,resident,frags,byte_runs in prefetch(iter_deleted_files('temp.dfxml'),PARSE_AHEAD):
+        files_progress.update()
+        if not byte_runs: # won't write to DB if no byte_run (prob size=0)
+            continue
+        file_id = add_file(conn_c,filename,resident,frags)
+        for offset,length in byte_runs:
+            sectors = [offset] # sectors in this byte run; always at least one
+            length = length - SECTOR_SIZE # will be greater than 0 if more than one sector in this byte run
+            while length > 0:
+                offset = offset+SECTOR_SIZE
+                sectors.append(offset)
+                length = length - SECTOR_SIZE # will still be greater than 0 if more sectors in this byte run
+            rows = []
+            base = []
+            for run_start,run_offsets,run in read_runs(f_img,sectors,mm): # one read for the whole byte run
+                t = time.perf_counter()
+                for offset in run_offsets:
+                    with run[offset-run_start : offset-run_start+SECTOR_SIZE] as sector:
+                        rows.append((file_id,img_id,offset,sector_digest(sector)))
+                        if needs_base_sectors(): # cache the contents for later images to compare against
+                            base.append((offset,file_id,bytes(sector)))
+                progress.add_time('hash',time.perf_counter() - t)
+            if base:
+                conn_c.executemany('INSERT OR IGNORE INTO base_sectors VALUES (?,?,?);',base) # committed with the sectors rows
+            for row in rows:
+                yield row
+    files_progress.done()
+
+def local_name(name):
+    # tag or attribute name without its {namespace}
+    return name.rsplit('}',1)[-1]
+
+def iter_deleted_files(dfxml):
+    # stream deleted files from an idifference2 DFXML file; yields (filename, resident, frags, byte_runs)
+    # where byte_runs is a list of (img_offset, length); elements are matched by name and attribute,
+    # not by position, and each top level fileobject is discarded once parsed so memory stays bounded
+    stack = [] # open elements
+    depth = 0 # fileobject nesting
+    for event,elem in ET.iterparse(dfxml,events=('start','end')):
+        if event == 'start':
+            stack.append(elem)
+            if local_name(elem.tag) == 'fileobject':
+                depth+=1
+            continue
+        stack.pop()
+        if local_name(elem.tag) != 'fileobject':
+            continue
+        depth-=1
+        if depth > 0: # fileobject inside delta:original_fileobject; handled with its parent
+            continue
+        if any((local_name(k) == 'deleted_file') and (v == '1') for k,v in elem.attrib.items()):
+            record = parse_deleted_file(elem)
+            if record is not None:
+                yield record
+        elem.clear()
+        if stack:
+            stack[-1].remove(elem)
+
+def parse_deleted_file(elem):
+    # (filename, resident, frags, byte_runs) from a deleted fileobject element, using its
+    # delta:original_fileobject data; None if it has none
+    original = None
+    for child in elem.iter():
+        if local_name(child.tag) == 'original_fileobject':
+            original = child
+            break
+    if original is None:
+        return None
+    filename = None
+    resident = False
+    frags = 0
+    byte_runs = []
+    saved_img_offset = None # base offset for continuation byte_run(s)
+    for child in original.iter():
+        name = local_name(child.tag)
+        if (name == 'filename') and (filename is None):
+            filename = child.text or ''
+        if name != 'byte_run':
+            continue
+        attrib = dict((local_name(k),v) for k,v in child.attrib.items())
+        if attrib.get('type') == 'resident':
+            resident = True
+        if 'img_offset' in attrib:
+            frags+=1
+        if attrib.get('fill') == '0': # byte_run of all zeros not worth tracking; nor are the runs after it
+            break
+        length = int(attrib.get('uncompressed_len',attrib.get('len',0)))
+        if 'img_offset' in attrib:
+            offset = int(attrib['img_offset'])
+            saved_img_offset = offset
+        elif ('file_offset' in attrib) and (saved_img_offset is not None): # continuation byte_run
+            offset = saved_img_offset + int(attrib['file_offset'])
+        else:
+            continue
+        byte_runs.append((offset,length))
+    return (filename,resident,frags,byte_runs)
+
+def prefetch(items,depth):
+    # run an iterator in a background thread, at most depth items ahead of the consumer;
+    # exceptions in the thread are raised in the consumer
+    q = queue.Queue(maxsize=depth)
+    done = object()
+    def produce():
+        try:
+            for item in items:
+                q.put(item)
+            q.put(done)
+        except BaseException as e:
+            q.put(e)
+    threading.Thread(target=produce,daemon=True).start()
+    while True:
+        item = q.get()
+        if item is done:
+            return
+        if isinstance(item,BaseException):
+            raise item
+        yield item
+
+def open_db(db_file='deleted.db'):
+    # open deleted.db with WAL journaling and the tuned pragmas above
+    conn_c = sqlite3.connect(db_file)
+    conn_c.execute('PRAGMA journal_mode=WAL;')
+    conn_c.execute('PRAGMA synchronous='+DB_SYNCHRONOUS+';')
+    conn_c.execute('PRAGMA cache_size='+str(DB_CACHE_SIZE)+';')
+    return conn_c
+
+def create_db(conn_c):
+    # create the tables and indexes if they do not exist; schema:
+    #   images:  one row per processed image; id is the image's position in IMAGE_LIST (0 = base image);
+    #            size, mtime and checksum identify the image file for incremental runs
+    #   files:   one row per tracked deleted file; frags is the number of fragments found
+    #   sectors: one row per tracked sector per image; digest format and fingerprint are recorded in meta
+    #   sector_state: first image where a base image sector changed (EARLY_TERMINATION); no row = still intact
+    #   base_sectors: contents of the tracked base image sectors (FINGERPRINT='compare' or VERIFY_MATCHES only)
+    #   deleted_files: read-only view in the old one-table layout, for ad hoc queries
+    conn_c.execute('CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);')
+    conn_c.execute('CREATE TABLE IF NOT EXISTS images(id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL, checksum TEXT);')
+    columns = [row[1] for row in conn_c.execute('PRAGMA table_info(images);')]
+    for column,column_type in (('size','INTEGER'),('mtime','REAL'),('checksum','TEXT')): # dbs created before incremental runs
+        if column not in columns:
+            conn_c.execute('ALTER TABLE images ADD COLUMN '+column+' '+column_type+';')
+    conn_c.execute('CREATE TABLE IF NOT EXISTS files(id INTEGER PRIMARY KEY, filename TEXT UNIQUE, resident BOOLEAN, frags INTEGER);')
+    conn_c.execute('CREATE TABLE IF NOT EXISTS sectors(file_id INTEGER, img_id INTEGER, offset INTEGER, digest BLOB, '+\
+        'PRIMARY KEY(file_id,offset,img_id)) WITHOUT ROWID;') # primary key doubles as the per-file query index (trace_file.py)
+    conn_c.execute('CREATE INDEX IF NOT EXISTS sectors_img ON sectors(img_id);') # base image rows (hash_subsequent)
+    conn_c.execute('CREATE TABLE IF NOT EXISTS sector_state(file_id INTEGER, offset INTEGER, changed_at INTEGER, '+\
+        'PRIMARY KEY(file_id,offset)) WITHOUT ROWID;')
+    conn_c.execute('CREATE TABLE IF NOT EXISTS base_sectors(offset INTEGER, file_id INTEGER, contents BLOB, '+\
+        'PRIMARY KEY(offset,file_id)) WITHOUT ROWID;') # offset first: workers read the sectors of one offset range
+    conn_c.execute('CREATE VIEW IF NOT EXISTS deleted_files AS SELECT images.path AS img, files.filename, files.resident, '+\
+        'sectors.offset, files.frags, sectors.digest FROM sectors JOIN files ON files.id=sectors.file_id JOIN images ON images.id=sectors.img_id;')
+    conn_c.executemany('INSERT OR IGNORE INTO meta VALUES (?,?);',(('digest_format',DIGEST_FORMAT),('fingerprint',FINGERPRINT)))
+    conn_c.commit()
+
+def clear_db(conn_c):
+    # empty all tables for a fresh run
+    for table in ('sectors','sector_state','base_sectors','files','images','meta'):
+        conn_c.execute('DELETE from '+table+';')
+    conn_c.executemany('INSERT INTO meta VALUES (?,?);',(('digest_format',DIGEST_FORMAT),('fingerprint',FINGERPRINT)))
+    conn_c.commit()
+
+def add_images(conn_c,imgs):
+    # record the image series without file stats (e.g. migrated dbs); ids are positions in the list
+    conn_c.executemany('INSERT OR REPLACE INTO images(id,path) VALUES (?,?);',list(enumerate(imgs)))
+    conn_c.commit()
+
+def image_stats(img):
+    # (size, mtime, checksum) of an image file; checksum is the md5 of the size and the first and
+    # last CHECKSUM_BYTES of the image (the whole image if CHECKSUM_BYTES is 0)
+    st = os.stat(img)
+    h = hashlib.md5(str(st.st_size).encode())
+    with open(img,'rb') as fh:
+        if (CHECKSUM_BYTES == 0) or (st.st_size <= 2*CHECKSUM_BYTES):
+            for block in iter(lambda: fh.read(MAX_RUN),b''):
+                h.update(block)
+        else:
+            h.update(fh.read(CHECKSUM_BYTES))
+            fh.seek(st.st_size - CHECKSUM_BYTES)
+            h.update(fh.read(CHECKSUM_BYTES))
+    return (st.st_size,st.st_mtime,h.hexdigest())
+
+def record_image(conn_c,img):
+    # mark an image as processed (call after all of its sectors are in the db)
+    conn_c.execute('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?);',(IMAGE_LIST.index(img),img)+image_stats(img))
+    conn_c.commit()
+
+def processed_images(conn_c):
+    # images already in deleted.db; checks that they are still the first images in IMAGE_LIST and
+    # unchanged on disk (images recorded without stats get them recorded now), and that the db was
+    # written with the same DIGEST_FORMAT and FINGERPRINT; exits if not
+    for key,value in (('digest_format',DIGEST_FORMAT),('fingerprint',FINGERPRINT)):
+        recorded = conn_c.execute("SELECT value FROM meta WHERE key=?;",(key,)).fetchone()
+        if (recorded is not None) and (recorded[0] != value):
+            print('deleted.db was written with '+key.upper()+'='+recorded[0]+'; set INCREMENTAL=False to rebuild it')
+            sys.exit(1)
+    if needs_base_sectors() and (conn_c.execute("SELECT value FROM meta WHERE key='base_sectors';").fetchone() is None) and \
+        (conn_c.execute('SELECT COUNT(*) FROM images;').fetchone()[0] > 0):
+        print("deleted.db has no copy of the base image sectors (needed for FINGERPRINT='compare' and VERIFY_MATCHES); set INCREMENTAL=False to rebuild it")
+        sys.exit(1)
+    done = []
+    for img_id,path,size,mtime,checksum in conn_c.execute('SELECT id,path,size,mtime,checksum FROM images ORDER BY id;').fetchall():
+        if (img_id >= len(IMAGE_LIST)) or (IMAGE_LIST[img_id] != path):
+            print('Image '+str(img_id)+' in deleted.db ('+path+') does not match IMAGE_LIST; set INCREMENTAL=False to rebuild')
+            sys.exit(1)
+        if (size is None) and (mtime is None) and (checksum is None): # recorded without stats (add_images, migrate_db.py)
+            print('Image '+path+' has no size, mtime or checksum recorded in deleted.db; recording them now')
+            record_image(conn_c,path)
+        elif ((size,mtime,checksum) != image_stats(path)):
+            print('Image '+path+' changed since it was processed; set INCREMENTAL=False to rebuild')
+            sys.exit(1)
+        done.append(path)
+    return done
+
+def add_file(conn_c,filename,resident,frags):
+    # add a tracked file (or raise its frag count) and return its id
+    conn_c.execute('INSERT INTO files(filename,resident,frags) VALUES (?,?,?) '+\
+        'ON CONFLICT(filename) DO UPDATE SET frags=max(frags,excluded.frags);',(filename,resident,frags))
+    return conn_c.execute('SELECT id FROM files WHERE filename=?;',(filename,)).fetchone()[0]
+
+def insert_rows(conn_c,rows):
+    # write (file_id,img_id,offset,digest) rows to sectors with executemany, committing every DB_BATCH_SIZE rows;
+    # a sector listed twice for the same file (overlapping byte runs) is stored once
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= DB_BATCH_SIZE:
+            with progress.stage('db insert'):
+                conn_c.executemany('INSERT OR IGNORE into sectors VALUES (?,?,?,?)', batch)
+                conn_c.commit()
+            batch = []
+    if batch:
+        with progress.stage('db insert'):
+            conn_c.executemany('INSERT OR IGNORE into sectors VALUES (?,?,?,?)', batch)
+            conn_c.commit()
+
+FINGERPRINTS=('md5','blake2b','xxhash','crc','compare') # the FINGERPRINT values sector_digest() supports
+
+def sector_digest(sector_contents):
+    # FINGERPRINT of one sector in DIGEST_FORMAT; sector_contents may be bytes or a memoryview slice of a larger read
+    if FINGERPRINT == 'md5':
+        r = hashlib.md5(sector_contents).digest()
+    elif FINGERPRINT == 'blake2b':
+        r = hashlib.blake2b(sector_contents,digest_size=8).digest()
+    elif FINGERPRINT == 'xxhash':
+        r = xxhash.xxh64(sector_contents).digest()
+    elif FINGERPRINT == 'crc':
+        r = ((zlib.crc32(sector_contents) << 32) | zlib.adler32(sector_contents)).to_bytes(8,'big')
+    elif FINGERPRINT == 'compare': # the base image sector is the reference; changes are found in subsequent_digest()
+        return 0
+    if DIGEST_FORMAT == 'int64':
+        return int.from_bytes(r[:8],'big',signed=True) # sqlite integers are signed 64-bit
+    return r
+
+def needs_base_sectors():
+    # True if subsequent images are compared with the base image sector contents (base_sectors)
+    return (FINGERPRINT == 'compare') or VERIFY_MATCHES
+
+def base_contents(rows):
+    # base image contents of the sectors in rows (sorted by offset), from the base_sectors copy written
+    # by find_deleted(); one range query over its own read-only connection (pool workers, pipeline readers)
+    conn_c = sqlite3.connect('file:deleted.db?mode=ro',uri=True)
+    contents = {(file_id,offset):sector for offset,file_id,sector in conn_c.execute(
+        'SELECT offset,file_id,contents FROM base_sectors WHERE offset BETWEEN ? AND ?;',(rows[0][1],rows[-1][1]))}
+    conn_c.close()
+    return [contents[(row[0],row[1])] for row in rows]
+
+def subsequent_digest(sector,base_digest,base_sector):
+    # digest of a sector in a subsequent image; base_digest is the base image sector's stored digest and
+    # base_sector its contents (None unless needs_base_sectors())
+    if FINGERPRINT == 'compare':
+        return int(sector != base_sector)
+    digest = sector_digest(sector)
+    if (base_sector is not None) and (digest == base_digest) and (sector != base_sector): # fingerprint collision
+        if isinstance(digest,int):
+            return digest ^ 1 # any value other than the base digest records the change
+        return bytes([digest[0] ^ 1])+digest[1:]
+    return digest
+
+def base_rows(c):
+    # (file_id,offset,digest) rows of the base image sorted by offset; with EARLY_TERMINATION,
+    # only sectors that have not changed in any image processed so far
+    t = time.perf_counter()
+    if (EARLY_TERMINATION):
+        c.execute("SELECT file_id,offset,digest from sectors s where img_id=0 AND NOT EXISTS "+\
+            "(SELECT 1 FROM sector_state t WHERE t.file_id=s.file_id AND t.offset=s.offset) ORDER BY offset;")
+    else:
+        c.execute("SELECT file_id,offset,digest from sectors where img_id=0 ORDER BY offset;")
+    rows = c.fetchall()
+    progress.add_time('query',time.perf_counter() - t)
+    return rows
+
+def update_state(conn_c):
+    # add the sectors that changed in each processed image not yet accounted for in sector_state;
+    # images are handled in order, so changed_at is the first image where the sector changed
+    t = time.perf_counter()
+    row = conn_c.execute("SELECT value FROM meta WHERE key='state_through';").fetchone()
+    if row is None:
+        start = 1
+    else:
+        start = int(row[0])+1
+    last = conn_c.execute('SELECT max(id) FROM images;').fetchone()[0]
+    for img_id in range(start,last+1):
+        conn_c.execute('INSERT OR IGNORE INTO sector_state SELECT s.file_id,s.offset,s.img_id FROM sectors s '+\
+            'JOIN sectors b ON b.file_id=s.file_id AND b.offset=s.offset AND b.img_id=0 WHERE s.img_id=? AND s.digest!=b.digest;',(img_id,))
+    conn_c.execute("INSERT OR REPLACE INTO meta VALUES ('state_through',?);",(str(last),))
+    conn_c.commit()
+    progress.add_time('state update',time.perf_counter() - t)
+
+def plan_reads(offsets):
+    # sort sector offsets and merge neighbouring sectors into runs; returns a list of
+    # (run_start, run_end, [offsets]) where each run is read with a single mmap slice or read;
+    # duplicate offsets are kept, so the run lists line up with the sorted input
+    runs = []
+    for offset in sorted(offsets):
+        if runs:
+            run_start,run_end,run_offsets = runs[-1]
+            if (offset <= run_end + MAX_GAP) and (offset + SECTOR_SIZE - run_start <= MAX_RUN):
+                runs[-1] = (run_start,max(run_end,offset+SECTOR_SIZE),run_offsets)
+                run_offsets.append(offset)
+                continue
+        runs.append((offset,offset+SECTOR_SIZE,[offset]))
+    return runs
+
+def map_image(fh):
+    # return a read-only mmap of the open image for read_runs(), or None if USE_MMAP is off or
+    # the file can't be mapped (runs are then read with seek/read); the caller closes it
+    if not USE_MMAP:
+        return None
+    try:
+        return mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+    except (ValueError,OSError): # empty files, some block devices, etc.
+        return None
+
+def read_runs(fh,offsets,mm=None):
+    # yield (run_start, run_offsets, run) for each coalesced run of the sorted offsets, sliced from mm
+    # (the image's map_image(), so one map serves any number of calls) or read from fh; run is a
+    # memoryview of the run (zero-copy with mmap), so only use it (and slices of it) before asking
+    # for the next one; reads are timed as the 'read' stage; with mmap every page of the run is
+    # touched first, so the page faults are counted there and not in the hashing that follows
+    for run_start,run_end,run_offsets in plan_reads(offsets):
+        t = time.perf_counter()
+        if mm is not None:
+            run = memoryview(mm)[run_start:run_end]
+            run[::mmap.PAGESIZE].tobytes() # one byte from each page...
+            run[-1:].tobytes() # ...and the last one
+        else:
+            fh.seek(run_start)
+            run = memoryview(fh.read(run_end - run_start))
+        progress.add_time('read',time.perf_counter() - t)
+        with run:
+            yield run_start,run_offsets,run
 
 def hash_subsequent(img):
     print('Processing: '+img)
-    counter = 0
     print('Processing sectors in deleted.db:')
     # hash sectors from base image deleted files as they exist in subsequent images
-    f_img = open(img,'rb') # open image file for subsequent sector hashing
-    conn_c = sqlite3.connect("deleted.db")
+    conn_c = open_db()
     c = conn_c.cursor()
-    query="SELECT filename,resident,offset,frags from deleted_files where img=\""+IMAGE_LIST[0]+"\";" # get rows from first (base) image only
-    c.execute(query)
-    for row in c.fetchall():
-        counter+=1
-        print(str(counter)+'\r',end="")
-        filename,resident,offset,frags = row
-        md5 = compute_sector_md5(f_img,offset)
-        insert_values = (img,filename,resident,offset,frags,md5)
-        c.execute('INSERT into deleted_files VALUES (?,?,?,?,?,?)', insert_values)
-    conn_c.commit()
+    rows = base_rows(c) # get rows from first (base) image only
+    sectors_progress = progress.Progress('Sectors',total=len(rows))
+    for chunk in split_ranges(rows): # same units of work as the process pool, hashed here one at a time
+        batch = hash_range((IMAGE_LIST.index(img),img,chunk))
+        insert_rows(conn_c,batch)
+        sectors_progress.update(len(batch))
+    sectors_progress.done()
+    record_image(conn_c,img)
     conn_c.close()
-    f_img.close()
     print('\n')
 
+def split_ranges(rows):
+    # split base image rows (sorted by offset) into chunks spanning at most RANGE_SIZE bytes
+    # and holding at most BATCH_SIZE rows; each chunk is one unit of work for a hashing process
+    chunk = []
+    range_start = 0
+    for row in rows:
+        offset = row[1]
+        if chunk and ((offset - range_start >= RANGE_SIZE) or (len(chunk) >= BATCH_SIZE)):
+            yield chunk
+            chunk = []
+        if not chunk:
+            range_start = offset
+        chunk.append(row)
+    if chunk:
+        yield chunk
+
+WORKER_SETTINGS=('SECTOR_SIZE','FINGERPRINT','DIGEST_FORMAT','VERIFY_MATCHES','MAX_GAP','MAX_RUN','USE_MMAP')
+
+def worker_settings():
+    # the user-set vars hash_range() depends on, as set in this process (possibly changed at runtime by a driver)
+    return {name:globals()[name] for name in WORKER_SETTINGS}
+
+def init_worker(settings):
+    # pool initializer: apply the driver's settings in the worker; under the spawn and forkserver
+    # start methods workers re-import this file and would otherwise see its default values
+    globals().update(settings)
+
+def hash_range(task):
+    # worker: hash one chunk of sectors in one image, return the rows for the DB writer
+    img_id,img,rows = task
+    batch = []
+    base_sectors = None
+    if needs_base_sectors():
+        with progress.stage('read'):
+            base_sectors = base_contents(rows)
+    i = 0
+    with open(img,'rb') as f_img: # rows arrive sorted by offset, so they line up with the runs' offsets
+        mm = map_image(f_img)
+        for run_start,run_offsets,run in read_runs(f_img,[row[1] for row in rows],mm):
+            t = time.perf_counter()
+            for offset in run_offsets:
+                file_id,offset,base_digest = rows[i]
+                base_sector = None
+                if base_sectors is not None:
+                    base_sector = base_sectors[i]
+                with run[offset-run_start : offset-run_start+SECTOR_SIZE] as sector:
+                    batch.append((file_id,img_id,offset,subsequent_digest(sector,base_digest,base_sector)))
+                i+=1
+            progress.add_time('hash',time.perf_counter() - t)
+        if mm is not None:
+            mm.close()
+    return batch
+
+def hash_range_worker(task):
+    # pool worker: hash_range() and the stage times it recorded in this process, for the main process to add up
+    batch = hash_range(task)
+    times = dict(progress.stage_times)
+    progress.stage_times.clear()
+    return batch,times
+
+def hash_subsequent_parallel(imgs):
+    # hash sectors from base image deleted files in several subsequent images at once;
+    # worker processes hash offset ranges and this process is the only DB writer
+    print('Processing: '+', '.join(imgs)+' ('+str(NUM_WORKERS)+' workers)')
+    print('Processing sectors in deleted.db:')
+    conn_c = open_db()
+    c = conn_c.cursor()
+    rows = base_rows(c) # get rows from first (base) image only
+    chunks = list(split_ranges(rows))
+    tasks = ((IMAGE_LIST.index(img),img,chunk) for chunk in chunks for img in imgs) # interleave images so they are hashed side by side
+    sectors_progress = progress.Progress('Sectors',total=len(rows)*len(imgs))
+    def write(result):
+        batch,times = result.get()
+        progress.merge_times(times) # summed across workers
+        insert_rows(conn_c,batch)
+        sectors_progress.update(len(batch))
+    with multiprocessing.Pool(NUM_WORKERS,initializer=init_worker,initargs=(worker_settings(),)) as pool:
+        # at most NUM_WORKERS+QUEUE_DEPTH tasks in flight: a new task is only handed out once the
+        # oldest one's rows are written, so a slow writer holds the workers back instead of
+        # letting their batches pile up in this process
+        pending = collections.deque()
+        for task in tasks:
+            pending.append(pool.apply_async(hash_range_worker,(task,)))
+            if len(pending) >= NUM_WORKERS+QUEUE_DEPTH:
+                write(pending.popleft())
+        while pending:
+            write(pending.popleft())
+    sectors_progress.done()
+    for img in imgs:
+        record_image(conn_c,img)
+    conn_c.close()
+    print('\n')
+
+def hash_subsequent_pipeline(imgs):
+    # hash sectors from base image deleted files in subsequent images with a threaded pipeline:
+    #   readers: read each coalesced run of a chunk into one buffer  -> read_q
+    #   hashers: hash each sector of a run from memoryview slices    -> write_q
+    #   writer (this thread): batched inserts into deleted.db
+    # the queues are bounded (QUEUE_DEPTH), so a slow stage holds back the ones before it
+    hasher_threads = HASHER_THREADS
+    if hasher_threads is None:
+        hasher_threads = (os.cpu_count() or 1) if SECTOR_SIZE >= 2048 else 1
+    print('Processing: '+', '.join(imgs)+' ('+str(READER_THREADS)+' readers, '+str(hasher_threads)+' hashers)')
+    print('Processing sectors in deleted.db:')
+    conn_c = open_db()
+    c = conn_c.cursor()
+    tasks = queue.Queue()
+    rows = base_rows(c) # get rows from first (base) image only
+    for chunk in split_ranges(rows):
+        for img in imgs: # interleave images so they are read side by side
+            tasks.put((IMAGE_LIST.index(img),img,chunk))
+    read_q = queue.Queue(maxsize=QUEUE_DEPTH)
+    write_q = queue.Queue(maxsize=QUEUE_DEPTH)
+    errors = []
+    def reader():
+        try:
+            while True:
+                try:
+                    img_id,img,rows = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                base = None
+                if needs_base_sectors():
+                    with progress.stage('read'):
+                        base = base_contents(rows)
+                with open(img,'rb') as f_img:
+                    i = 0
+                    for run_start,run_end,run_offsets in plan_reads([row[1] for row in rows]):
+                        t = time.perf_counter()
+                        f_img.seek(run_start)
+                        buf = f_img.read(run_end - run_start)
+                        progress.add_time('read',time.perf_counter() - t)
+                        run_base = None
+                        if base is not None:
+                            run_base = base[i:i+len(run_offsets)]
+                        read_q.put((img_id,rows[i:i+len(run_offsets)],run_start,buf,run_base))
+                        i+=len(run_offsets)
+        except Exception as e:
+            errors.append(e)
+    def hasher():
+        for img_id,rows,run_start,buf,base in iter(read_q.get,None):
+            if errors: # keep draining so readers never block
+                continue
+            try:
+                t = time.perf_counter()
+                batch = []
+                with memoryview(buf) as run:
+                    for j,(file_id,offset,base_digest) in enumerate(rows):
+                        i = offset-run_start
+                        base_sector = None
+                        if base is not None:
+                            base_sector = base[j]
+                        batch.append((file_id,img_id,offset,subsequent_digest(run[i:i+SECTOR_SIZE],base_digest,base_sector)))
+                progress.add_time('hash',time.perf_counter() - t)
+                write_q.put(batch)
+            except Exception as e:
+                errors.append(e)
+    def closer(readers,hashers):
+        for t in readers:
+            t.join()
+        for t in hashers:
+            read_q.put(None)
+        for t in hashers:
+            t.join()
+        write_q.put(None)
+    readers = [threading.Thread(target=reader,daemon=True) for i in range(READER_THREADS)]
+    hashers = [threading.Thread(target=hasher,daemon=True) for i in range(hasher_threads)]
+    for t in readers+hashers:
+        t.start()
+    threading.Thread(target=closer,args=(readers,hashers),daemon=True).start()
+    sectors_progress = progress.Progress('Sectors',total=len(rows)*len(imgs))
+    def hashed_rows():
+        for batch in iter(write_q.get,None):
+            sectors_progress.update(len(batch))
+            for row in batch:
+                yield row
+    insert_rows(conn_c,hashed_rows())
+    sectors_progress.done()
+    if errors:
+        raise errors[0]
+    for img in imgs:
+        record_image(conn_c,img)
+    conn_c.close()
+    print('\n')
+
+def hash_images(new_imgs):
+    # hash the tracked sectors in subsequent images with the configured method and store them in deleted.db
+    if (EARLY_TERMINATION): # one image at a time, so each image only reads sectors still intact
+        conn_c = open_db()
+        update_state(conn_c) # catch up with images processed without early termination
+        conn_c.close()
+        img_groups = [[img] for img in new_imgs]
+    else:
+        img_groups = [new_imgs]
+    for imgs in img_groups:
+        if (len(imgs) == 0):
+            continue
+        if (PIPELINE): # hash sectors in other images with the threaded pipeline
+            hash_subsequent_pipeline(imgs)
+        elif (NUM_WORKERS > 1): # hash sectors in other images in parallel and store in DB
+            hash_subsequent_parallel(imgs)
+        else:
+            for img in imgs: # hash sectors in other images and store in DB
+                hash_subsequent(img)
+        if (EARLY_TERMINATION):
+            conn_c = open_db()
+            update_state(conn_c)
+            conn_c.close()
+
 if __name__ == "__main__":
     # run: python3 adiff.py &>console.log
     # need better option handling, help/usage
     print('Start: '+str(datetime.now()))
+    progress.configure(PROGRESS_INTERVAL,METRICS_FILE,PROFILE_FILE)
+    profiler = progress.start_profile()
+    progress.emit('start',program='adiff.py',images=len(IMAGE_LIST))
+    if FINGERPRINT not in FINGERPRINTS:
+        print("Unknown FINGERPRINT '"+str(FINGERPRINT)+"'; use one of: "+', '.join(FINGERPRINTS))
+        sys.exit(1)
+    if (FINGERPRINT == 'xxhash') and (xxhash is None):
+        print("FINGERPRINT='xxhash' needs the xxhash package (pip install xxhash)")
+        sys.exit(1)
     # create or clean deleted.db as necessary
-    if not (os.path.isfile('deleted.db')): # create db file if it does not exist
-        #cmd='sqlite3 deleted.db < create_deleted.sql'
-        cmd='sqlite3 deleted.db "CREATE TABLE deleted_files(img TEXT, filename TEXT, resident BOOLEAN, offset INTEGER, frags INTEGER, md5 TEXT);"'
-        print('Running: '+cmd)
-        os.system(cmd)
-    else: # empty the db file if it does exist
-        cmd='sqlite3 deleted.db "DELETE from deleted_files;"'
-        print('Running: '+cmd)
-        os.system(cmd)
-    find_deleted(IMAGE_LIST[0],IMAGE_LIST[1])
-    for i in range(1,len(IMAGE_LIST)): # hash sectors in other images and store in DB
-        hash_subsequent(IMAGE_LIST[i])
+    conn_c = open_db()
+    create_db(conn_c) # creates the tables and indexes if the db file does not exist
+    if (INCREMENTAL): # keep images already processed
+        done = processed_images(conn_c)
+        print('Already processed: '+str(len(done))+' images')
+    else:
+        clear_db(conn_c) # empty the tables if they do exist
+        done = []
+    if not done: # base image: find deleted files and hash their sectors
+        find_deleted(IMAGE_LIST[0],IMAGE_LIST[1])
+        record_image(conn_c,IMAGE_LIST[0])
+        done = IMAGE_LIST[:1]
+    conn_c.close()
+    new_imgs = IMAGE_LIST[len(done):]
+    hash_images(new_imgs)
+    progress.report_stages()
+    progress.stop_profile(profiler)
+    progress.emit('stop',program='adiff.py')
     print('Stop: '+str(datetime.now()))
 
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+#
+# bench.py:
+# benchmark adiff.py and trace_file.py on a synthetic image series; generates raw images with
+# deleted files (optionally fragmented), decays them across snapshots, writes a matching
+# temp.dfxml, then times find_deleted, hash_subsequent, compute_changes and plot_persistence
+#
+# 10/18/26: original coding
+# 10/18/26: plot_persistence time includes the batched render_plots() pass
+
+import os
+import sys
+import time
+import random
+import shutil
+import resource
+import contextlib
+import adiff
+import trace_file
+
+### User-set vars...
+WORK_DIR='bench_work' # directory for the synthetic images, temp.dfxml, deleted.db and outputs
+IMAGE_SIZE=256*1024*1024 # bytes per synthetic image
+SECTOR_SIZE=512 # 512,4096,...
+NUM_SNAPSHOTS=8 # images in the series (image 0 is the base image)
+NUM_FILES=2000 # deleted files to track
+MAX_FILE_SECTORS=64 # file sizes are uniform in 1..MAX_FILE_SECTORS sectors
+FRAGMENTATION=0.2 # fraction of files split into fragments
+MAX_FRAGS=4 # max fragments per fragmented file
+OVERWRITE_RATE=0.02 # fraction of image sectors overwritten between consecutive snapshots
+SEED=1 # random seed; the same settings and seed give the same images
+KEEP_IMAGES=False # True reuses the images and temp.dfxml already in WORK_DIR (only the timed stages are rerun)
+TRACE_FILES=None # number of files to run compute_changes/plot_persistence on; None for all
+### end User-set vars
+
+def generate(rng):
+    # write image0..imageN and temp.dfxml in the current directory; returns the image list
+    num_sectors = IMAGE_SIZE // SECTOR_SIZE
+    # lay out file extents across the image with random gaps, then hand them to files in random
+    # order so fragments of a file end up scattered
+    sizes = [rng.randint(1,MAX_FILE_SECTORS) for i in range(NUM_FILES)]
+    pieces = []
+    for file_num,size in enumerate(sizes):
+        frags = 1
+        if (rng.random() < FRAGMENTATION) and (size > 1):
+            frags = rng.randint(2,min(MAX_FRAGS,size))
+        cuts = sorted(rng.sample(range(1,size),frags-1))
+        for start,end in zip([0]+cuts,cuts+[size]):
+            pieces.append((file_num,start,end-start))
+    rng.shuffle(pieces)
+    free = num_sectors - sum(sizes)
+    if free < 0:
+        print('IMAGE_SIZE too small for NUM_FILES * MAX_FILE_SECTORS')
+        sys.exit(1)
+    mean_gap = free // (len(pieces)+1)
+    runs = [[] for i in range(NUM_FILES)]
+    sector = 0
+    for file_num,file_sector,length in pieces:
+        gap = rng.randint(0,min(2*mean_gap,free)) # never more than is left, so extents do not overlap
+        free -= gap
+        sector += gap
+        runs[file_num].append((file_sector,sector,length))
+        sector += length
+    # base image: random contents
+    imgs = ['image'+str(k)+'.img' for k in range(NUM_SNAPSHOTS)]
+    with open(imgs[0],'wb') as fo:
+        remaining = IMAGE_SIZE
+        while remaining > 0:
+            n = min(remaining,8*1024*1024)
+            fo.write(rng.randbytes(n))
+            remaining -= n
+    # snapshots: copy the previous image and overwrite OVERWRITE_RATE of its sectors
+    # (image 1 is left identical to image 0, as if taken right after the deletions)
+    for k in range(1,NUM_SNAPSHOTS):
+        shutil.copyfile(imgs[k-1],imgs[k])
+        if k == 1:
+            continue
+        fd = os.open(imgs[k],os.O_WRONLY)
+        for s in sorted(rng.sample(range(num_sectors),int(num_sectors*OVERWRITE_RATE))):
+            os.pwrite(fd,rng.randbytes(SECTOR_SIZE),s*SECTOR_SIZE)
+        os.close(fd)
+    # matching idifference2-style DFXML: one line per deleted fileobject
+    with open('temp.dfxml','w') as fo:
+        fo.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        fo.write('<dfxml xmlns="http://www.forensicswiki.org/wiki/Category:Digital_Forensics_XML" '+\
+            'xmlns:delta="http://www.forensicswiki.org/wiki/Separating_mutable_and_immutable_properties_in_DFXML" version="1.0">\n')
+        for file_num in range(NUM_FILES):
+            byte_runs = ''
+            for file_sector,sector,length in sorted(runs[file_num]):
+                byte_runs += '<byte_run file_offset="'+str(file_sector*SECTOR_SIZE)+'" fs_offset="'+str(sector*SECTOR_SIZE)+\
+                    '" img_offset="'+str(sector*SECTOR_SIZE)+'" uncompressed_len="'+str(length*SECTOR_SIZE)+'"/>'
+            fo.write('<fileobject delta:deleted_file="1"><delta:original_fileobject><fileobject><filename>bench/file'+\
+                str(file_num)+'.dat</filename><filesize>'+str(sizes[file_num]*SECTOR_SIZE)+'</filesize><byte_runs>'+\
+                byte_runs+'</byte_runs></fileobject></delta:original_fileobject></fileobject>\n')
+        fo.write('</dfxml>\n')
+    return imgs
+
+def timed(fn,*args):
+    # run fn with its console output discarded; returns (seconds, result)
+    with open(os.devnull,'w') as devnull, contextlib.redirect_stdout(devnull):
+        t = time.perf_counter()
+        result = fn(*args)
+        return time.perf_counter() - t,result
+
+def report(stage,seconds,sectors):
+    rate = sectors/seconds if seconds > 0 else 0.0
+    print('{0:<18} {1:>10.3f} s {2:>12} sectors {3:>14.0f} sectors/s {4:>10.2f} MB/s'.format(
+        stage,seconds,sectors,rate,rate*SECTOR_SIZE/(1024*1024)))
+
+def peak_rss_mb():
+    # peak resident set of this process and of its child processes (the largest of the waited-for children,
+    # e.g. pool workers); ru_maxrss is KB on Linux, bytes on macOS
+    scale = 1024*1024 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own/scale,children/scale
+
+def run():
+    rng = random.Random(SEED)
+    os.makedirs(WORK_DIR,exist_ok=True)
+    os.chdir(WORK_DIR)
+    imgs = ['image'+str(k)+'.img' for k in range(NUM_SNAPSHOTS)]
+    if not (KEEP_IMAGES and all(os.path.exists(img) for img in imgs+['temp.dfxml'])):
+        print('Generating '+str(NUM_SNAPSHOTS)+' images of '+str(IMAGE_SIZE)+' bytes in '+WORK_DIR+'...')
+        t = time.perf_counter()
+        imgs = generate(rng)
+        print('Generated in '+format(time.perf_counter()-t,'.1f')+' s\n')
+    for f in ('deleted.db','deleted.db-wal','deleted.db-shm','graphdata.out','processed.csv'):
+        if os.path.exists(f):
+            os.remove(f)
+    # adiff.py
+    adiff.IMAGE_LIST = imgs
+    adiff.SECTOR_SIZE = SECTOR_SIZE
+    adiff.HAVE_TEMP_DFXML = True
+    conn_c = adiff.open_db()
+    adiff.create_db(conn_c)
+    adiff.clear_db(conn_c)
+    seconds,result = timed(adiff.find_deleted,imgs[0],imgs[1])
+    adiff.record_image(conn_c,imgs[0])
+    base_sectors = conn_c.execute('SELECT COUNT(*) FROM sectors WHERE img_id=0;').fetchone()[0]
+    conn_c.close()
+    report('find_deleted',seconds,base_sectors)
+    seconds,result = timed(adiff.hash_images,imgs[1:])
+    conn_c = adiff.open_db()
+    hashed = conn_c.execute('SELECT COUNT(*) FROM sectors WHERE img_id>0;').fetchone()[0]
+    conn_c.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+    conn_c.close()
+    report('hash_subsequent',seconds,hashed)
+    # trace_file.py
+    trace_file.NUM_IMAGES = trace_file.count_images()
+    trace_file.SECTOR_SIZE = SECTOR_SIZE
+    conn_c = trace_file.sqlite3.connect(trace_file.DB)
+    files = [row for row in conn_c.execute('SELECT filename,resident,frags FROM files ORDER BY id;')][:TRACE_FILES]
+    conn_c.close()
+    total_changes = 0
+    changes_seconds = 0.0
+    plot_seconds = 0.0
+    for filename,resident,frags in files:
+        seconds,changes = timed(trace_file.compute_changes,filename)
+        changes_seconds += seconds
+        total_changes += len(changes)
+        seconds,result = timed(trace_file.plot_persistence,filename,resident,frags,len(changes),changes)
+        plot_seconds += seconds
+    seconds,result = timed(trace_file.render_plots) # all-on-one curves are drawn once, at the end
+    plot_seconds += seconds
+    report('compute_changes',changes_seconds,total_changes*trace_file.NUM_IMAGES)
+    report('plot_persistence',plot_seconds,total_changes)
+    own,children = peak_rss_mb()
+    line = '\nPeak RSS: '+format(own,'.1f')+' MB (this process)'
+    if (not adiff.PIPELINE) and (adiff.NUM_WORKERS > 1): # hash_images() used the process pool
+        line += ', '+format(children,'.1f')+' MB (peak for child processes)'
+    print(line)
+    print('DB size: '+format(os.path.getsize('deleted.db')/(1024*1024),'.2f')+' MB ('+str(base_sectors)+' tracked sectors, '+\
+        str(NUM_SNAPSHOTS)+' images, '+str(len(files))+' files traced)')
+
+if __name__ == "__main__":
+    # run: python3 bench.py (from the python directory, or with it on PYTHONPATH)
+    run()
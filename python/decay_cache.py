@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+#
+# decay_cache.py:
+# persisted cache of per-file decay results computed by trace_file.py (first-change image of each sector,
+# sectors remaining R[k] at each image), keyed to a fingerprint of the source deleted.db;
+# aggregate survival queries (by extension, resident flag, frag count) are answered from the cache
+#
+# run: python3 decay_cache.py [all|ext|resident|frags]   (after trace_file.py has processed all files with USE_CACHE)
+#
+# 10/18/26: original coding
+
+import os
+import sys
+import hashlib
+import itertools
+import sqlite3
+import numpy as np
+
+# Settings
+CACHE_DB = 'decay.db' # results cache written by trace_file.py; rebuilt when the source DB changes
+GROUP_COLUMNS = ('ext','resident','frags') # columns survival can be grouped by
+
+def source_fingerprint(db,num_images,sector_size):
+        ''' fingerprint of a deleted.db and the settings its results depend on; the DB's size and
+            modification time (and those of its WAL file) change whenever adiff.py writes to it
+        '''
+        parts = [os.path.abspath(db),num_images,sector_size]
+        for path in (db,db+'-wal'):
+                if os.path.exists(path):
+                        st = os.stat(path)
+                        parts += [st.st_size,st.st_mtime_ns]
+        return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+def open_cache(cache_db=CACHE_DB):
+        ''' opens (creating if needed) the results cache
+        '''
+        conn_c = sqlite3.connect(cache_db)
+        conn_c.execute('CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);')
+        conn_c.execute('CREATE TABLE IF NOT EXISTS files(id INTEGER PRIMARY KEY, filename TEXT UNIQUE, ext TEXT, '+\
+            'resident INTEGER, frags INTEGER, total_sectors INTEGER);')
+        conn_c.execute('CREATE TABLE IF NOT EXISTS survival(file_id INTEGER, img_id INTEGER, remaining INTEGER, '+\
+            'PRIMARY KEY(file_id,img_id)) WITHOUT ROWID;') # R[k]: sectors still intact at each image
+        conn_c.execute('CREATE TABLE IF NOT EXISTS changes(file_id INTEGER, offset INTEGER, changed_at INTEGER, '+\
+            'PRIMARY KEY(file_id,offset)) WITHOUT ROWID;') # first image where each sector changed (0 means never)
+        conn_c.commit()
+        return conn_c
+
+def get_meta(conn_c,key):
+        row = conn_c.execute('SELECT value FROM meta WHERE key=?;',(key,)).fetchone()
+        return row[0] if row else None
+
+def set_meta(conn_c,key,value):
+        conn_c.execute('INSERT OR REPLACE INTO meta VALUES (?,?);',(key,str(value)))
+
+def is_fresh(conn_c,fingerprint):
+        ''' True if the cached results were computed from the DB (and settings) with this fingerprint
+        '''
+        return get_meta(conn_c,'fingerprint') == fingerprint
+
+def is_complete(conn_c,fingerprint):
+        ''' True if the cache is fresh and holds every file in the DB (written by a '*' run)
+        '''
+        return is_fresh(conn_c,fingerprint) and get_meta(conn_c,'complete') == '1'
+
+def reset(conn_c,fingerprint,db,num_images,sector_size):
+        ''' empties the cache and keys it to a new source DB fingerprint
+        '''
+        for table in ('files','survival','changes','meta'):
+                conn_c.execute('DELETE FROM '+table+';')
+        set_meta(conn_c,'fingerprint',fingerprint)
+        set_meta(conn_c,'source_db',os.path.abspath(db))
+        set_meta(conn_c,'num_images',num_images)
+        set_meta(conn_c,'sector_size',sector_size)
+        set_meta(conn_c,'complete',0)
+        conn_c.commit()
+
+def mark_complete(conn_c):
+        set_meta(conn_c,'complete',1)
+        conn_c.commit()
+
+def store_result(conn_c,result):
+        ''' stores one file's (filename,resident,frags,total_sectors,changes,R,P) result (not committed)
+        '''
+        filename,resident,frags,total_sectors,changes,R,P = result
+        ext = os.path.splitext(filename)[1][1:].strip().lower()
+        c = conn_c.execute('INSERT OR REPLACE INTO files(filename,ext,resident,frags,total_sectors) VALUES (?,?,?,?,?);',\
+            (filename,ext,int(resident),frags,int(total_sectors)))
+        file_id = c.lastrowid
+        conn_c.executemany('INSERT OR REPLACE INTO survival VALUES (?,?,?);',[(file_id,k,int(r)) for k,r in enumerate(R)])
+        conn_c.executemany('INSERT OR REPLACE INTO changes VALUES (?,?,?);',[(file_id,int(offset),int(changed)) for offset,changed in changes])
+
+def make_result(file_row,remaining,changes):
+        ''' rebuilds a trace_file.py result tuple from cached rows
+        '''
+        file_id,filename,resident,frags,total_sectors = file_row
+        R = np.array(remaining,dtype=np.int64)
+        P = (R/total_sectors)*100.0
+        if changes is not None:
+                changes = np.array(changes,dtype=np.int64).reshape(-1,2)
+        return (filename,resident,frags,total_sectors,changes,R,P)
+
+def load_result(conn_c,filename):
+        ''' returns the cached result for one file, or None if it is not in the cache
+        '''
+        file_row = conn_c.execute('SELECT id,filename,resident,frags,total_sectors FROM files WHERE filename=?;',(filename,)).fetchone()
+        if file_row is None:
+                return None
+        remaining = [row[0] for row in conn_c.execute('SELECT remaining FROM survival WHERE file_id=? ORDER BY img_id;',(file_row[0],))]
+        changes = conn_c.execute('SELECT offset,changed_at FROM changes WHERE file_id=? ORDER BY offset;',(file_row[0],)).fetchall()
+        return make_result(file_row,remaining,changes)
+
+def iter_results(conn_c,with_changes=True):
+        ''' streams every cached result in file order; changes are only read if with_changes
+            (one ordered scan of each table, like trace_file.iter_file_digests)
+        '''
+        f = conn_c.cursor()
+        s = conn_c.cursor()
+        f.execute('SELECT id,filename,resident,frags,total_sectors FROM files ORDER BY id;')
+        s.execute('SELECT file_id,remaining FROM survival ORDER BY file_id,img_id;')
+        survival = itertools.groupby(s,key=lambda row: row[0])
+        if(with_changes):
+                c = conn_c.cursor()
+                c.execute('SELECT file_id,offset,changed_at FROM changes ORDER BY file_id,offset;')
+                changes = itertools.groupby(c,key=lambda row: row[0])
+        for file_row in f:
+                remaining = [row[1] for row in next(survival)[1]]
+                file_changes = [row[1:] for row in next(changes)[1]] if with_changes else None
+                yield make_result(file_row,remaining,file_changes)
+
+def output_stats(paths):
+        return {path:[os.path.getsize(path),os.stat(path).st_mtime_ns] if os.path.exists(path) else None for path in paths}
+
+def record_outputs(conn_c,fingerprint,paths):
+        ''' records the output files written from the results with this fingerprint
+        '''
+        set_meta(conn_c,'outputs',repr([fingerprint,output_stats(paths)]))
+        conn_c.commit()
+
+def outputs_current(conn_c,fingerprint,paths):
+        ''' True if the output files were written from these results and have not been touched since
+        '''
+        return get_meta(conn_c,'outputs') == repr([fingerprint,output_stats(paths)])
+
+def survival_by(conn_c,column=None):
+        ''' aggregate survival from the cache, grouped by a column in GROUP_COLUMNS (None for all files);
+            returns (group,files,total_sectors,remaining) rows where remaining[k] is the number of
+            the group's sectors intact at image k
+        '''
+        if(column is not None) and (column not in GROUP_COLUMNS):
+                raise ValueError('cannot group by '+column+'; use one of '+', '.join(GROUP_COLUMNS))
+        group = "'all'" if column is None else 'files.'+column
+        groups = conn_c.execute('SELECT '+group+',COUNT(*),SUM(total_sectors) FROM files GROUP BY 1 ORDER BY 1;').fetchall()
+        remaining = {}
+        query = 'SELECT '+group+',img_id,SUM(remaining) FROM survival JOIN files ON files.id=file_id GROUP BY 1,2 ORDER BY 1,2;'
+        for value,img_id,count in conn_c.execute(query):
+                remaining.setdefault(value,[]).append(count)
+        return [(value,files,total_sectors,remaining.get(value,[])) for value,files,total_sectors in groups]
+
+def print_survival(rows):
+        ''' prints survival_by() rows as % of sectors intact at each image
+        '''
+        num_images = max((len(row[3]) for row in rows),default=0)
+        print('{0:<12} {1:>8} {2:>10}'.format('group','files','sectors')+''.join('{0:>8}'.format(k) for k in range(num_images)))
+        for group,files,total_sectors,remaining in rows:
+                print('{0:<12} {1:>8} {2:>10}'.format(str(group),files,total_sectors)+\
+                    ''.join('{0:>8.2f}'.format(r/total_sectors*100.0) for r in remaining))
+
+if __name__ == "__main__":
+        column = sys.argv[1] if len(sys.argv) > 1 else 'all'
+        if not os.path.exists(CACHE_DB):
+                print(CACHE_DB+' not found; run trace_file.py on all files (*) with USE_CACHE first')
+                sys.exit(1)
+        conn_c = open_cache(CACHE_DB)
+        db = get_meta(conn_c,'source_db')
+        if (db is None) or not is_complete(conn_c,source_fingerprint(db,int(get_meta(conn_c,'num_images')),int(get_meta(conn_c,'sector_size')))):
+                print(CACHE_DB+' is out of date with '+str(db)+' (or incomplete); run trace_file.py on all files (*) to rebuild it')
+                sys.exit(1)
+        try:
+                rows = survival_by(conn_c,None if column == 'all' else column)
+        except ValueError as e:
+                print(e)
+                sys.exit(1)
+        print('Survival by '+column+' (% of sectors intact at each image) from '+CACHE_DB+':')
+        print_survival(rows)
+        conn_c.close()
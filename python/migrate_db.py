@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+#
+# migrate_db.py:
+# convert a deleted.db written by older versions of adiff.py (one deleted_files table with
+# TEXT img, filename and md5 columns) to the normalized layout used by adiff.py and trace_file.py
+#
+# 10/18/26: original coding
+# 10/18/26: rate-limited progress with ETA; db insert time reported at the end
+
+import os
+import sys
+import sqlite3
+from datetime import datetime
+import adiff
+import progress
+
+### User-set vars...
+OLD_DB='deleted.db' # db in the old layout
+NEW_DB='deleted_new.db' # db to create in the new layout; must not exist
+DIGEST_FORMAT='blob' # 'blob' keeps the 16-byte md5 digest; 'int64' keeps its first 8 bytes as an integer (smaller DB)
+### end User-set vars
+
+def migrate(old_db,new_db):
+    conn_o = sqlite3.connect(old_db)
+    o = conn_o.cursor()
+    conn_n = adiff.open_db(new_db)
+    adiff.DIGEST_FORMAT = DIGEST_FORMAT
+    adiff.create_db(conn_n)
+    # images in the order they were added to the old db (base image first)
+    print('Reading images...')
+    o.execute('SELECT img,min(rowid) FROM deleted_files GROUP BY img ORDER BY 2;')
+    imgs = [row[0] for row in o.fetchall()]
+    adiff.add_images(conn_n,imgs)
+    img_ids = dict((img,img_id) for img_id,img in enumerate(imgs))
+    print('Images: '+str(len(imgs)))
+    # one files row per filename, in the order they were first added (trace_file.py writes output in file id
+    # order); old rows carry the running frag count, so keep the max
+    print('Reading files...')
+    file_ids = {}
+    for filename,resident,frags in o.execute('SELECT filename,max(resident),max(frags) FROM deleted_files GROUP BY filename ORDER BY min(rowid);'):
+        file_ids[filename] = adiff.add_file(conn_n,filename,resident,frags)
+    conn_n.commit()
+    print('Files: '+str(len(file_ids)))
+    # sectors
+    print('Converting sectors:')
+    sectors_progress = progress.Progress('Sectors',total=(o.execute('SELECT COUNT(*) FROM deleted_files;').fetchone())[0])
+    def converted_rows():
+        for img,filename,offset,md5 in o.execute('SELECT img,filename,offset,md5 FROM deleted_files;'):
+            sectors_progress.update()
+            digest = bytes.fromhex(md5)
+            if DIGEST_FORMAT == 'int64':
+                digest = int.from_bytes(digest[:8],'big',signed=True)
+            yield (file_ids[filename],img_ids[img],offset,digest)
+    adiff.insert_rows(conn_n,converted_rows())
+    sectors_progress.done()
+    print('\n')
+    conn_n.close()
+    conn_o.close()
+
+if __name__ == "__main__":
+    # run: python3 migrate_db.py (from the directory holding OLD_DB)
+    if os.path.exists(NEW_DB):
+        print(NEW_DB+' already exists; remove it or set NEW_DB')
+        sys.exit(1)
+    print('Start: '+str(datetime.now()))
+    migrate(OLD_DB,NEW_DB)
+    progress.report_stages()
+    print('Wrote '+NEW_DB+': '+str(os.path.getsize(OLD_DB))+' -> '+str(os.path.getsize(NEW_DB))+' bytes')
+    print('Stop: '+str(datetime.now()))
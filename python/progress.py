@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+#
+# progress.py:
+# rate-limited progress lines, per-stage timers, JSON-lines metrics and cProfile dumps
+# shared by adiff.py and trace_file.py
+#
+# 10/18/26: original coding
+
+import sys
+import json
+import time
+import threading
+import cProfile
+import contextlib
+
+# Settings (set through configure() by the calling program)
+PROGRESS_INTERVAL = 1.0 # seconds between progress line updates
+METRICS_FILE = None # append JSON-lines metrics here (progress, stage times); None disables
+PROFILE_FILE = None # write a cProfile dump of the main process here; None disables
+
+stage_times = {} # stage name -> [seconds, calls]
+lock = threading.Lock()
+
+def configure(progress_interval=1.0,metrics_file=None,profile_file=None):
+        ''' sets the module settings from the calling program's user-set vars
+        '''
+        global PROGRESS_INTERVAL,METRICS_FILE,PROFILE_FILE
+        PROGRESS_INTERVAL = progress_interval
+        METRICS_FILE = metrics_file
+        PROFILE_FILE = profile_file
+
+def emit(event,**fields):
+        ''' appends one JSON metrics record (with a timestamp) to METRICS_FILE
+        '''
+        if METRICS_FILE is None:
+                return
+        fields['event'] = event
+        fields['time'] = time.time()
+        with lock:
+                with open(METRICS_FILE,'a') as fo:
+                        fo.write(json.dumps(fields)+'\n')
+
+def format_seconds(seconds):
+        seconds = int(seconds)
+        return '{0}:{1:02d}:{2:02d}'.format(seconds//3600,(seconds//60)%60,seconds%60)
+
+class Progress:
+        ''' progress counter that redraws its line at most every PROGRESS_INTERVAL seconds,
+            with throughput and (if the total is known) % done and ETA
+        '''
+        def __init__(self,label,total=None,unit='sectors'):
+                self.label = label
+                self.total = total
+                self.unit = unit
+                self.count = 0
+                self.start = time.monotonic()
+                self.last = self.start
+
+        def update(self,n=1):
+                self.count += n
+                now = time.monotonic()
+                if (now - self.last) >= PROGRESS_INTERVAL:
+                        self.last = now
+                        self.show(now)
+
+        def show(self,now,end=''):
+                elapsed = now - self.start
+                rate = self.count/elapsed if elapsed > 0 else 0.0
+                line = self.label+': '+str(self.count)
+                fields = {'label':self.label,'count':self.count,'unit':self.unit,'elapsed':elapsed,'rate':rate}
+                if self.total:
+                        line += '/'+str(self.total)+' ('+format(100.0*self.count/self.total,'.1f')+'%)'
+                        fields['total'] = self.total
+                line += '  '+format(rate,'.0f')+' '+self.unit+'/s'
+                if self.total and (rate > 0) and (self.count < self.total):
+                        eta = (self.total - self.count)/rate
+                        line += '  ETA '+format_seconds(eta)
+                        fields['eta'] = eta
+                print('\r'+line+'   ',end=end)
+                sys.stdout.flush()
+                emit('progress',**fields)
+
+        def done(self):
+                self.show(time.monotonic(),end='\n')
+
+def add_time(name,seconds,calls=1):
+        ''' adds time spent in a stage (e.g. measured in a worker and sent back)
+        '''
+        with lock:
+                total = stage_times.setdefault(name,[0.0,0])
+                total[0] += seconds
+                total[1] += calls
+
+def merge_times(times):
+        ''' adds a {name: [seconds, calls]} dict of stage times from a worker
+        '''
+        for name,(seconds,calls) in times.items():
+                add_time(name,seconds,calls)
+
+@contextlib.contextmanager
+def stage(name):
+        ''' times the enclosed block as part of a named stage
+        '''
+        t = time.perf_counter()
+        try:
+                yield
+        finally:
+                add_time(name,time.perf_counter() - t)
+
+def report_stages():
+        ''' prints the time spent in each stage and records it in the metrics file;
+            stages that run in workers or threads are summed across them
+        '''
+        if not stage_times:
+                return
+        print('Stage times (summed across workers/threads):')
+        for name,(seconds,calls) in sorted(stage_times.items(),key=lambda item: -item[1][0]):
+                print('  {0:<16} {1:>10.3f} s {2:>10} calls'.format(name,seconds,calls))
+                emit('stage',stage=name,seconds=seconds,calls=calls)
+
+def start_profile():
+        ''' starts cProfile if PROFILE_FILE is set; returns the profiler (or None)
+        '''
+        if PROFILE_FILE is None:
+                return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+def stop_profile(profiler):
+        ''' stops the profiler from start_profile() and writes PROFILE_FILE (read with pstats or snakeviz)
+        '''
+        if profiler is None:
+                return
+        profiler.disable()
+        profiler.dump_stats(PROFILE_FILE)
+        print('Profile written to '+PROFILE_FILE)
@@ -16,6 +16,25 @@
 # 06-24-16: jhj  fixed resident translation bug (boolean to string)
 # 06-25-16: jhj  really fixed resident translation bug (boolean to string) - sql "LIKE" was returning too many hits, resident was OK
 #                also fixed repeated writes to csv for each frag value (now do a secondary query for max(frags)
+# 10-18-26: read the normalized deleted.db layout (files/images/sectors tables, binary digests);
+#           per-file rows are ordered by offset and image id; queries use bound parameters
+# 10-18-26: vectorized compute_changes/plot_persistence: a file's digests are loaded once into a
+#           (sectors x images) numpy array; first change, R/L/P computed with argmax/bincount/cumsum
+# 10-18-26: '*' now runs analyze_all(): one connection, one ordered scan of the sectors table,
+#           grouped per file in a generator; graphdata.out/processed.csv written in the same pass
+# 10-18-26: added process pool for '*' (NUM_WORKERS): workers analyze ranges of files over their own
+#           read-only connection and render per-file plots; output is merged in file order
+# 10-18-26: NUM_IMAGES defaults to the number of images recorded in the DB (incremental adiff runs)
+# 10-18-26: rate-limited files progress with ETA for '*'; per-stage timers (query, compute, plot, write),
+#           JSON-lines metrics (METRICS_FILE) and cProfile dumps (PROFILE_FILE) via progress.py
+# 10-18-26: results cache (USE_CACHE, decay_cache.py): per-file results are kept in CACHE_DB keyed to a
+#           fingerprint of DB; '*' and single files are answered from it while DB is unchanged, and
+#           graphdata.out/processed.csv are only rewritten when stale (listing files no longer truncates them)
+#           (per-file plots of cached results are still rendered across NUM_WORKERS processes)
+# 10-18-26: a cached single-file lookup leaves up-to-date all-files graphdata.out/processed.csv alone
+# 10-18-26: plots are rendered in a batch: all-on-one curves are collected and drawn once at the end
+#           (one LineCollection, or a density heatmap past DENSITY_THRESHOLD files); per-file plots reuse
+#           one figure and line; optional PNG output (PLOT_FORMAT) and one multi-page PDF (PLOT_PAGES)
 
 # for debugging
 #import pdb
@@ -24,147 +43,471 @@
 
 import os
 import sqlite3
+import itertools
+import collections
+import multiprocessing
+import time
 import numpy as np
 import matplotlib
 matplotlib.use('pdf')
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.colors import LogNorm,to_rgba_array
+from matplotlib.backends.backend_pdf import PdfPages
+import progress
+import decay_cache
 
 # Globals
 DB = 'deleted.db' # DB to use
-DBT = 'deleted_files' # DB table to use
-NUM_IMAGES = 13 # number of images originally processed
+DBT = 'sectors' # DB table of tracked sector digests
+DBF = 'files' # DB table of tracked files
+NUM_IMAGES = None # number of images processed; None reads it from the DB
 SECTOR_SIZE = 512 # sector size of imaged media filesystem
 # Flags (ToDo: set by CLI flags)
 CREATE_GRAPHS = True # plots line graphs of persistence as PDF files; written to ./plots/filename.pdf
 WRITE_FILE = True # writes graph data to a file (graphdata.out)
 PLOT_ALL_ON_ONE = True # plots all lines on one graph; dense but interesting; otherwise one plot per file
+PLOT_FORMAT = 'pdf' # 'pdf' or 'png' (png is quicker to write and view for many per-file plots)
+PLOT_PAGES = False # per-file plots go into one multi-page ./plots/files.pdf instead of one file per file
+DENSITY_THRESHOLD = 10000 # all-on-one plots of more files than this show a density heatmap instead of one line per file; None always draws lines
 OUTPUT_CHANGES_BY_IMAGE = False # outputs persistence (* and .) for each sector across the images
 OUTPUT_FINAL_PERSISTENCE = True # output final % persistence
 CREATE_PROCESSED_CSV = True # write processed file data to a sqlite3 db file for subsequent analysis
+NUM_WORKERS = (os.cpu_count() or 1) # processes used when processing all files (*); 1 processes files one after another
+FILES_PER_TASK = 100 # files handed to a worker at a time when NUM_WORKERS > 1
+PROGRESS_INTERVAL = 1.0 # seconds between progress line updates
+METRICS_FILE = None # file to append JSON-lines metrics to (progress, stage times); None disables
+PROFILE_FILE = None # file to write a cProfile dump of the main process to; None disables
+USE_CACHE = True # keep per-file results in CACHE_DB and reuse them while DB is unchanged (see decay_cache.py)
+CACHE_DB = 'decay.db' # results cache; rebuilt automatically when DB changes
+
+def count_images():
+        ''' returns number of images recorded in the DB by adiff.py
+        '''
+        conn_c = sqlite3.connect(DB)
+        num_images = (conn_c.execute('SELECT COUNT(*) FROM images;').fetchone())[0]
+        conn_c.close()
+        return num_images
 
 def compute_num_sectors(filename):
         ''' computes number of sectors being tracked for a file
         '''
         conn_c = sqlite3.connect(DB)
         c = conn_c.cursor()
-        #query = "SELECT COUNT(DISTINCT offset) from "+DBT+" WHERE filename LIKE '%"+filename+"%';"
-        query = "SELECT COUNT(DISTINCT offset) from "+DBT+" WHERE filename='"+filename+"';"
-        c.execute(query)
+        query = "SELECT COUNT(DISTINCT offset) from "+DBT+" JOIN "+DBF+" ON "+DBF+".id=file_id WHERE filename=?;"
+        c.execute(query,(filename,))
         total_sectors=(c.fetchone())[0]
         conn_c.close()
         return total_sectors
 
-def compute_changes(filename):
-        ''' computes changes to sectors of a file and returns list with data
+def load_digests(filename):
+        ''' loads a file's sector digests from the DB as (offset,img_id,digest) rows
         '''
-        counter = 0 # for progress counter
-        print('Processing sectors in DB (total_sectors * NUM_IMAGES):')
-        changes=[]
         conn_c = sqlite3.connect(DB)
         c = conn_c.cursor()
-        #query = "SELECT offset,md5 FROM "+DBT+" WHERE filename LIKE '%"+filename+"%' ORDER BY offset;"
-        query = "SELECT offset,md5 FROM "+DBT+" WHERE filename='"+filename+"' ORDER BY offset;"
-        img = 0 # initialize image counter
-        for row in c.execute(query):
-                counter+=1
-                print(str(counter)+'\r',end="")
-                offset = row[0]
-                md5 = row[1]
-                if(img==0): # first image in the series
-                        initial_md5 = md5
-                        changed = 0 # value 0 means no change; non-0 indicates image where change first found
-                        img+=1
-                elif(img==(NUM_IMAGES-1)): # last image in the series
-                        if(changed!=0): # already recorded change, so write, reset, and continue
-                                changes.append((offset,changed))
-                                img=0
-                        else:
-                                if(md5!=initial_md5):
-                                        changed=img # set changed value to current image
-                                changes.append((offset,changed))
-                                img=0
-                else: # neither first nor last image in the series
-                        if(changed!=0): # already recorded change, so increment and continue
-                                img+=1
-                        else:
-                                if(md5!=initial_md5):
-                                        changed=img # set changed value to current image
-                                img+=1
-        print('\n')
+        query = "SELECT offset,img_id,digest FROM "+DBT+" JOIN "+DBF+" ON "+DBF+".id=file_id WHERE filename=? ORDER BY offset,img_id;"
+        with progress.stage('query'):
+                rows = c.execute(query,(filename,)).fetchall()
         conn_c.close()
-        return changes
+        return rows
+
+def digest_matrix(rows):
+        ''' arranges (offset,img_id,digest) rows into a (sectors x images) array;
+            returns sorted offsets, the digest array, and a mask of the cells that have a row
+        '''
+        offsets,sector_index = np.unique(np.array([row[0] for row in rows],dtype=np.int64),return_inverse=True)
+        img_index = np.array([row[1] for row in rows],dtype=np.int64)
+        values = np.array([row[2] for row in rows]) # S16 for blob digests, int64 for int64 digests
+        digests = np.zeros((len(offsets),NUM_IMAGES),dtype=values.dtype)
+        present = np.zeros((len(offsets),NUM_IMAGES),dtype=bool)
+        digests[sector_index,img_index] = values
+        present[sector_index,img_index] = True
+        return offsets,digests,present
+
+def first_changes(digests,present):
+        ''' returns the image where each sector first differs from image 0 (0 means never changed);
+            a missing row counts as changed
+        '''
+        changed = (digests != digests[:,:1]) | ~present
+        changed[:,0] = False
+        return np.where(changed.any(axis=1),changed.argmax(axis=1),0)
+
+def compute_changes(filename):
+        ''' computes changes to sectors of a file and returns array of (offset,changed) rows
+        '''
+        print('Processing sectors in DB (total_sectors * NUM_IMAGES):')
+        rows = load_digests(filename)
+        print(str(len(rows))+'\n')
+        with progress.stage('compute'):
+                offsets,digests,present = digest_matrix(rows)
+                return np.column_stack((offsets,first_changes(digests,present)))
+
+def compute_persistence(total_sectors,changes):
+        ''' computes sectors Remaining (R), Lost (L) and % survived (P) at each image from (offset,changed) rows
+        '''
+        L = np.bincount(np.asarray(changes,dtype=np.int64).reshape(-1,2)[:,1],minlength=NUM_IMAGES) # number changed, i.e., Lost, at each image
+        L[0] = 0 # changed value 0 means never changed; all sectors always persist in image 0
+        R = total_sectors - np.cumsum(L) # number unchanged, i.e., Remaining, at each image
+        P = (R/total_sectors)*100.0 # % survived at each image
+        return R,L,P
 
 def plot_persistence(filename,resident,frags,total_sectors,changes):
         ''' Computes % intact and plots simple line graph
         '''
         # compute survived at each image
-        R = [] # list of number unchanged, i.e., Remaining, at each image
-        for i in range (0,NUM_IMAGES): # init list with 0 counts
-                R.append(0)
-        L = [] # list of number changed, i.e., Lost, at each image
-        for i in range (0,NUM_IMAGES): # init list with 0 counts
-                L.append(0)
-        for j in [x[1] for x in changes]: # http://stackoverflow.com/questions/
-                                          # 3308102/how-to-extract-the-n-th-elements-from-a-list-of-tuples-in-python
-                L[j]+=1
-        # compute values to plot
-        P = [] # list of % survived at each image
-        for i in range (0,NUM_IMAGES): # init list with 0 values
-                P.append(0)
-        P[0] = float((total_sectors/total_sectors)*100.0) # all sectors always persist in image 0
-        R[0] = total_sectors # all sectors always persist in image 0
-        sectors_remaining = total_sectors # starting point
-        for k in range (1,NUM_IMAGES): # compute % sectors remaining
-                P[k] = float(((sectors_remaining - L[k])/total_sectors)*100.0)
-                R[k] = sectors_remaining - L[k]
-                sectors_remaining -= L[k] # running total of sectors remaining
+        R,L,P = compute_persistence(total_sectors,changes)
+        sectors_remaining = int(R[NUM_IMAGES-1])
         # plot
         if(CREATE_GRAPHS):
-                # create plots directory if it does not exist
-                if not os.path.exists('./plots/'):
-                    os.makedirs('./plots/')
-                fn = (filename.split('/'))[-1]
-                x = range (0,NUM_IMAGES)
-                y = P
-                plt.plot(x,y,marker='.',markersize=8)
-                # ToDo: restrict x-axis to integers...
-                if(PLOT_ALL_ON_ONE): # different title and don't clear the figure between plots
-                        plt.title('Deleted File Sector Persistence: All Files', size = 10)
-                        plt.ylim(ymin = -1.0, ymax = 101.0)
-                        plt.ylabel('% Sectors Intact')
-                        plt.xlabel('Image ID (sequential)')
-                        plt.savefig('./plots/all.pdf')
-                else: # different title and clear the figure between plots
-                        fp = "{0:.2f}".format(P[NUM_IMAGES-1]) # create rounded string of final persistence
-                        plt.title('Deleted File Sector Persistence: '+fn+' (final persistence: '+fp+'%  '+\
-                            str(sectors_remaining)+'/'+str(total_sectors)+')\n'+filename, size = 8)
-                        plt.ylim(ymin = -1.0, ymax = 101.0)
-                        plt.ylabel('% Sectors Intact')
-                        plt.xlabel('Image ID (sequential)')
-                        plt.savefig('./plots/'+fn+'.pdf')
-                        plt.clf()
+                plot_curve(filename,total_sectors,sectors_remaining,P)
         # write graph data to file
+        with progress.stage('write'):
+                if(WRITE_FILE):
+                        fo = open('graphdata.out','a') # opening for append, since created new file in main block
+                        write_graphdata(fo,filename,total_sectors,R,P)
+                        fo.close()
+                # write processed data to csv file
+                if(CREATE_PROCESSED_CSV):
+                        fo = open('processed.csv','a') # opening for append, since created new file in main block
+                        write_processed_csv(fo,filename,resident,frags,total_sectors,R)
+                        fo.close()
+        return sectors_remaining
+
+# plot state: curves collected for the all-on-one plot, the figure reused for per-file plots,
+# and the open multi-page PDF; render_plots() draws the collected curves and closes the PDF
+curves = []
+file_figure = None
+file_line = None
+pages = None
+
+def plot_curve(filename,total_sectors,sectors_remaining,P):
+        ''' Plots simple line graph of % intact at each image; for all-on-one the curve is
+            only collected here and drawn by render_plots()
+        '''
+        global file_figure,file_line,pages
+        t = time.perf_counter()
+        if(PLOT_ALL_ON_ONE):
+                curves.append(P)
+                progress.add_time('plot',time.perf_counter() - t)
+                return
+        # create plots directory if it does not exist
+        if not os.path.exists('./plots/'):
+            os.makedirs('./plots/')
+        fn = (filename.split('/'))[-1]
+        if(file_figure is None): # one figure and line, redrawn with each file's data
+                file_figure = Figure()
+                ax = file_figure.add_subplot()
+                file_line, = ax.plot(range(0,NUM_IMAGES),np.zeros(NUM_IMAGES),marker='.',markersize=8)
+                # ToDo: restrict x-axis to integers...
+                ax.set_ylim(bottom = -1.0, top = 101.0)
+                ax.set_ylabel('% Sectors Intact')
+                ax.set_xlabel('Image ID (sequential)')
+        file_line.set_ydata(P)
+        fp = "{0:.2f}".format(P[NUM_IMAGES-1]) # create rounded string of final persistence
+        file_figure.axes[0].set_title('Deleted File Sector Persistence: '+fn+' (final persistence: '+fp+'%  '+\
+            str(sectors_remaining)+'/'+str(total_sectors)+')\n'+filename, size = 8)
+        if(PLOT_PAGES):
+                if(pages is None):
+                        pages = PdfPages('./plots/files.pdf')
+                pages.savefig(file_figure)
+        else:
+                file_figure.savefig('./plots/'+fn+'.'+PLOT_FORMAT)
+        progress.add_time('plot',time.perf_counter() - t)
+
+def render_plots():
+        ''' Renders the collected all-on-one curves in one pass (one line collection, or a density
+            heatmap of % intact at each image past DENSITY_THRESHOLD files) and closes the multi-page PDF
+        '''
+        global pages
+        t = time.perf_counter()
+        if(pages is not None):
+                pages.close()
+                pages = None
+        if not curves:
+                return
+        if not os.path.exists('./plots/'):
+            os.makedirs('./plots/')
+        x = np.arange(NUM_IMAGES)
+        y = np.array(curves)
+        fig = Figure()
+        ax = fig.add_subplot()
+        if(DENSITY_THRESHOLD is not None) and (len(curves) > DENSITY_THRESHOLD):
+                bins = np.clip(np.rint(y),0,100).astype(np.int64) # 1% bins
+                counts = np.column_stack([np.bincount(bins[:,k],minlength=101) for k in range(0,NUM_IMAGES)])
+                image = ax.imshow(np.ma.masked_equal(counts,0),origin='lower',aspect='auto',norm=LogNorm(),\
+                    extent=(-0.5,NUM_IMAGES-0.5,-0.5,100.5))
+                fig.colorbar(image,ax=ax,label='Files')
+                ax.set_title('Deleted File Sector Persistence: All Files (density of '+str(len(curves))+' files)', size = 10)
+        else:
+                cycle = matplotlib.rcParams['axes.prop_cycle'].by_key()['color']
+                colors = to_rgba_array([cycle[i % len(cycle)] for i in range(0,len(curves))]) # same colors as one plot() per file
+                ax.add_collection(LineCollection(np.stack((np.broadcast_to(x,y.shape),y),axis=-1),colors=colors))
+                ax.scatter(np.tile(x,len(curves)),y.ravel(),c=np.repeat(colors,NUM_IMAGES,axis=0),marker='.',s=64,linewidths=0)
+                ax.autoscale_view()
+                ax.set_title('Deleted File Sector Persistence: All Files', size = 10)
+        ax.set_ylim(bottom = -1.0, top = 101.0)
+        ax.set_ylabel('% Sectors Intact')
+        ax.set_xlabel('Image ID (sequential)')
+        fig.savefig('./plots/all.'+PLOT_FORMAT)
+        curves.clear()
+        progress.add_time('plot',time.perf_counter() - t)
+
+def write_graphdata(fo,filename,total_sectors,R,P):
+        ''' Writes one file's graph data (graphdata.out format) to an open file
+        '''
+        fo.write('FILENAME: '+filename+'\n')
+        fo.write('TOTAL_SECTORS: '+str(total_sectors)+'\n')
+        for k in range (0,NUM_IMAGES): 
+                fp = "{0:.2f}".format(P[k]) # create rounded string of persistence percent
+                fo.write('IMAGE (R/T %): '+str(k)+' ('+str(R[k])+'/'+str(total_sectors)+' '+str(fp)+'%)\n')
+        fo.write('\n')
+
+def write_processed_csv(fo,filename,resident,frags,total_sectors,R):
+        ''' Writes one file's processed data (processed.csv row) to an open file
+        '''
+        ext = os.path.splitext(filename)[1][1:].strip().lower()
+        total_bytes = total_sectors * SECTOR_SIZE
+        fo.write(filename+','+ext+','+str(total_sectors)+','+str(total_bytes)+','+str(int(resident))+','+str(frags))
+        for k in range (0,NUM_IMAGES): 
+                fo.write(','+str(R[k]))
+        fo.write('\n')
+
+def print_final_persistence(sectors_remaining,total_sectors):
+        ''' Prints final % persistence and n/m
+        '''
+        final_persistence_percent = format((float(sectors_remaining/total_sectors)*100.0), '.2f')
+        print('Final Persistence: '+str(final_persistence_percent)+ \
+                '% ('+str(sectors_remaining)+'/'+str(total_sectors)+')\n')
+
+def iter_file_digests(conn_c,first_id=None,last_id=None):
+        ''' streams (filename,resident,frags,rows) for each file in the DB, where rows are that file's
+            (offset,img_id,digest) rows; one ordered scan of the sectors table (its primary key order,
+            so no sort) merged with one scan of the files table; only one file's rows are held at a time;
+            first_id/last_id restrict the scan to a range of file ids
+        '''
+        where = ''
+        params = ()
+        if(first_id is not None):
+                where = ' WHERE {0} BETWEEN ? AND ?'
+                params = (first_id,last_id)
+        f = conn_c.cursor()
+        s = conn_c.cursor()
+        f.execute('SELECT id,filename,resident,frags FROM '+DBF+where.format('id')+' ORDER BY id;',params)
+        s.execute('SELECT file_id,offset,img_id,digest FROM '+DBT+where.format('file_id')+' ORDER BY file_id,offset,img_id;',params)
+        file_row = f.fetchone()
+        t = time.perf_counter()
+        for file_id,group in itertools.groupby(s,key=lambda row: row[0]):
+                while file_row[0] != file_id: # skip files with no tracked sectors
+                        file_row = f.fetchone()
+                rows = [row[1:] for row in group]
+                progress.add_time('query',time.perf_counter() - t) # time spent in the scan, not in the caller
+                yield file_row[1],file_row[2],file_row[3],rows
+                t = time.perf_counter()
+
+def analyze_file(filename,resident,frags,rows):
+        ''' computes changes and persistence for one file from its (offset,img_id,digest) rows;
+            returns (filename,resident,frags,total_sectors,changes,R,P)
+        '''
+        t = time.perf_counter()
+        offsets,digests,present = digest_matrix(rows)
+        total_sectors = len(offsets)
+        changes = np.column_stack((offsets,first_changes(digests,present)))
+        R,L,P = compute_persistence(total_sectors,changes)
+        progress.add_time('compute',time.perf_counter() - t)
+        return (filename,resident,frags,total_sectors,changes,R,P)
+
+def report_file(result,fo_graph,fo_csv,plot=True):
+        ''' prints, plots and writes the output for one analyzed file
+        '''
+        filename,resident,frags,total_sectors,changes,R,P = result
+        sectors_remaining = int(R[NUM_IMAGES-1])
+        print('\nFilename: '+filename)
+        print('Total Sectors: '+str(total_sectors))
+        if(OUTPUT_CHANGES_BY_IMAGE):
+                show_changes_by_image(filename,total_sectors,changes) # disable when running all?
+        if(CREATE_GRAPHS and plot):
+                plot_curve(filename,total_sectors,sectors_remaining,P)
+        with progress.stage('write'):
+                if(fo_graph is not None):
+                        write_graphdata(fo_graph,filename,total_sectors,R,P)
+                if(fo_csv is not None):
+                        write_processed_csv(fo_csv,filename,resident,frags,total_sectors,R)
+        if(OUTPUT_FINAL_PERSISTENCE):
+                print_final_persistence(sectors_remaining,total_sectors)
+
+WORKER_SETTINGS = ('DB','DBT','DBF','NUM_IMAGES','SECTOR_SIZE','CREATE_GRAPHS','PLOT_ALL_ON_ONE','PLOT_PAGES','PLOT_FORMAT',\
+    'OUTPUT_CHANGES_BY_IMAGE','USE_CACHE')
+
+def worker_settings():
+        ''' the globals analyze_range() depends on, as set in this process (possibly changed at runtime by a driver)
+        '''
+        return {name:globals()[name] for name in WORKER_SETTINGS}
+
+def init_worker(settings):
+        ''' applies the main process's settings in this worker (under the spawn and forkserver start
+            methods workers re-import this file and would otherwise see its defaults) and opens a
+            read-only DB connection
+        '''
+        global worker_conn
+        globals().update(settings)
+        worker_conn = sqlite3.connect('file:'+DB+'?mode=ro',uri=True)
+
+def analyze_range(id_range):
+        ''' worker: analyzes the files in a range of file ids; per-file plots are rendered here,
+            everything else is returned (in file order) for the main process to write,
+            along with the worker's stage times for this range
+        '''
+        results = []
+        for filename,resident,frags,rows in iter_file_digests(worker_conn,id_range[0],id_range[1]):
+                result = analyze_file(filename,resident,frags,rows)
+                if(CREATE_GRAPHS and not (PLOT_ALL_ON_ONE or PLOT_PAGES)): # a multi-page PDF is written by the main process
+                        filename,resident,frags,total_sectors,changes,R,P = result
+                        plot_curve(filename,total_sectors,int(R[NUM_IMAGES-1]),P)
+                if not (OUTPUT_CHANGES_BY_IMAGE or USE_CACHE): # only needed for the console and the cache; keep results small
+                        result = result[:4]+(None,)+result[5:]
+                results.append(result)
+        times = dict(progress.stage_times)
+        progress.stage_times.clear()
+        return results,times
+
+def plot_range(plots):
+        ''' worker: renders the per-file plots for a batch of (filename,total_sectors,R,P) cached results;
+            returns the worker's stage times
+        '''
+        for filename,total_sectors,R,P in plots:
+                plot_curve(filename,total_sectors,int(R[NUM_IMAGES-1]),P)
+        times = dict(progress.stage_times)
+        progress.stage_times.clear()
+        return times
+
+def file_id_ranges(conn_c):
+        ''' splits the file ids in the DB into ranges of FILES_PER_TASK files
+        '''
+        ids = [row[0] for row in conn_c.execute('SELECT id FROM '+DBF+' ORDER BY id;')]
+        return [(ids[i],ids[min(i+FILES_PER_TASK,len(ids))-1]) for i in range(0,len(ids),FILES_PER_TASK)]
+
+def output_files():
+        ''' returns the output files enabled by the flags
+        '''
+        return [path for path,enabled in (('graphdata.out',WRITE_FILE),('processed.csv',CREATE_PROCESSED_CSV)) if enabled]
+
+def reset_outputs():
+        ''' creates new (empty) output files, replacing any from an earlier run
+        '''
         if(WRITE_FILE):
-                fo = open('graphdata.out','a') # opening for append, since created new file in main block
-                #ext = os.path.splitext(filename)[1][1:].strip().lower()
-                fo.write('FILENAME: '+filename+'\n')
-                fo.write('TOTAL_SECTORS: '+str(total_sectors)+'\n')
-                for k in range (0,NUM_IMAGES): 
-                        fp = "{0:.2f}".format(P[k]) # create rounded string of persistence percent
-                        fo.write('IMAGE (R/T %): '+str(k)+' ('+str(R[k])+'/'+str(total_sectors)+' '+str(fp)+'%)\n')
-                fo.write('\n')
+                fo = open('graphdata.out','w') # creates a new file in case it already exists
                 fo.close()
-        # write processed data to csv file
         if(CREATE_PROCESSED_CSV):
-                ext = os.path.splitext(filename)[1][1:].strip().lower()
-                total_bytes = total_sectors * SECTOR_SIZE
-                fo = open('processed.csv','a') # opening for append, since created new file in main block
-                fo.write(filename+','+ext+','+str(total_sectors)+','+str(total_bytes)+','+str(int(resident))+','+str(frags))
-                for k in range (0,NUM_IMAGES): 
-                        fo.write(','+str(R[k]))
-                fo.write('\n')
+                fo = open('processed.csv','w') # creates a new file with headers
+                fo.write('filename,ext,total_sectors,total_bytes,resident,frags,persistence...\n') # headers
                 fo.close()
-        return sectors_remaining
+
+def open_outputs():
+        ''' opens the enabled output files for append; returns (fo_graph,fo_csv), None for disabled outputs
+        '''
+        fo_graph = open('graphdata.out','a') if(WRITE_FILE) else None
+        fo_csv = open('processed.csv','a') if(CREATE_PROCESSED_CSV) else None
+        return fo_graph,fo_csv
+
+def open_cache():
+        ''' opens the results cache for DB; returns (cache connection,fingerprint of DB);
+            a cache computed from a different DB (or a changed one) is emptied
+        '''
+        fingerprint = decay_cache.source_fingerprint(DB,NUM_IMAGES,SECTOR_SIZE)
+        cache = decay_cache.open_cache(CACHE_DB)
+        if not decay_cache.is_fresh(cache,fingerprint):
+                decay_cache.reset(cache,fingerprint,DB,NUM_IMAGES,SECTOR_SIZE)
+        return cache,fingerprint
+
+def analyzed_results(conn_c):
+        ''' streams (result,plotted) for every file in DB in file id order, computed in this process
+            or across NUM_WORKERS processes; plotted is True if a worker already rendered its plot
+        '''
+        if(NUM_WORKERS > 1):
+                ranges = file_id_ranges(conn_c)
+                with multiprocessing.Pool(NUM_WORKERS,initializer=init_worker,initargs=(worker_settings(),)) as pool:
+                        for results,times in pool.imap(analyze_range,ranges): # imap keeps ranges in order
+                                progress.merge_times(times)
+                                for result in results:
+                                        yield result,not (PLOT_ALL_ON_ONE or PLOT_PAGES) # per-file plots were rendered by the worker
+        else:
+                for filename,resident,frags,rows in iter_file_digests(conn_c):
+                        yield analyze_file(filename,resident,frags,rows),False
+
+def cached_results(cache):
+        ''' streams (result,plotted) for every file in the cache in file id order; per-file plots are
+            handed to NUM_WORKERS processes in batches of FILES_PER_TASK files, as analyzed_results() does
+        '''
+        results = decay_cache.iter_results(cache,OUTPUT_CHANGES_BY_IMAGE)
+        if not (CREATE_GRAPHS and (NUM_WORKERS > 1)) or (PLOT_ALL_ON_ONE or PLOT_PAGES): # nothing to hand off
+                for result in results:
+                        yield result,False
+                return
+        with multiprocessing.Pool(NUM_WORKERS,initializer=init_worker,initargs=(worker_settings(),)) as pool:
+                pending = collections.deque()
+                plots = []
+                for result in results:
+                        filename,resident,frags,total_sectors,changes,R,P = result
+                        plots.append((filename,total_sectors,R,P))
+                        if(len(plots) == FILES_PER_TASK):
+                                pending.append(pool.apply_async(plot_range,(plots,)))
+                                plots = []
+                                if(len(pending) > 2*NUM_WORKERS): # reading the cache outpaces plotting; wait for the oldest batch
+                                        progress.merge_times(pending.popleft().get())
+                        yield result,True
+                if(plots):
+                        pending.append(pool.apply_async(plot_range,(plots,)))
+                while(pending):
+                        progress.merge_times(pending.popleft().get())
+
+def analyze_all():
+        ''' processes every file in the DB in a single pass over one connection, or spread across
+            NUM_WORKERS processes; output is written in file id order either way; with USE_CACHE the
+            results are read from (or saved to) CACHE_DB, and up-to-date output files are left alone
+        '''
+        conn_c = sqlite3.connect(DB)
+        cache = None
+        cached = False
+        outputs = output_files()
+        write_outputs = True
+        if(USE_CACHE):
+                cache,fingerprint = open_cache()
+                cached = decay_cache.is_complete(cache,fingerprint)
+                if(cached):
+                        print('Using cached results from '+CACHE_DB)
+                        if(outputs and decay_cache.outputs_current(cache,fingerprint,outputs)):
+                                print(', '.join(outputs)+' already up to date')
+                                write_outputs = False
+                else: # start over so the cache holds every file, in file id order
+                        decay_cache.reset(cache,fingerprint,DB,NUM_IMAGES,SECTOR_SIZE)
+        fo_graph,fo_csv = None,None
+        if(write_outputs):
+                reset_outputs()
+                fo_graph,fo_csv = open_outputs()
+        files_progress = progress.Progress('Files',total=(conn_c.execute('SELECT COUNT(*) FROM '+DBF+';').fetchone())[0],unit='files')
+        if(cached):
+                results = cached_results(cache)
+        else:
+                results = analyzed_results(conn_c)
+        for result,plotted in results:
+                if(cache is not None) and not (cached):
+                        with progress.stage('cache'):
+                                decay_cache.store_result(cache,result)
+                report_file(result,fo_graph,fo_csv,plot=not plotted)
+                files_progress.update()
+        files_progress.done()
+        render_plots()
+        if(fo_graph is not None):
+                fo_graph.close()
+        if(fo_csv is not None):
+                fo_csv.close()
+        if(cache is not None):
+                if not (cached):
+                        decay_cache.mark_complete(cache)
+                if(write_outputs):
+                        decay_cache.record_outputs(cache,fingerprint,outputs)
+                cache.close()
+        conn_c.close()
 
 def show_changes_by_image(filename,total_sectors,changes):
         ''' Prints simple graphic showing sector-by-sector decay over images
@@ -185,67 +528,70 @@ def show_changes_by_image(filename,total_sectors,changes):
         print('\n')
 
 if __name__ == "__main__":
-        if(WRITE_FILE):
-                fo = open('graphdata.out','w') # creates a new file in case it already exists
-                fo.close() # could leave open and pass filehandle in, then close at end...faster?
-        if(CREATE_PROCESSED_CSV):
-                fo = open('processed.csv','w') # creates a new file with headers
-                fo.write('filename,ext,total_sectors,total_bytes,resident,frags,persistence...\n') # headers
-                fo.close() # could leave open and pass filehandle in, then close at end...faster?
+        progress.configure(PROGRESS_INTERVAL,METRICS_FILE,PROFILE_FILE)
+        profiler = progress.start_profile()
+        progress.emit('start',program='trace_file.py')
+        if(NUM_IMAGES is None):
+                NUM_IMAGES = count_images()
         filename = input('Filename to process (null to list files in the DB, * to process all): ')
         if(filename==''): # list files in the DB
                 counter = 0
                 conn_c = sqlite3.connect(DB)
                 c = conn_c.cursor()
-                query = 'SELECT distinct filename FROM '+DBT+';'
+                query = 'SELECT filename FROM '+DBF+';'
                 for row in c.execute(query):
                         print(row[0])
                         counter +=1
                 print('\nTotal files: '+str(counter)+'\n')
                 conn_c.close()
         elif(filename=='*'): # process all files in the DB
-                conn_c = sqlite3.connect(DB)
-                c = conn_c.cursor()
-                d = conn_c.cursor()
-                #query = 'SELECT distinct filename,resident,frags FROM '+DBT+';' # testing to select only max(frags) entry in DB...
-                query = 'SELECT distinct filename FROM '+DBT+';'
-                for row in c.execute(query):
-                        current_filename = row[0]
-                        query = "SELECT filename,resident,max(frags) FROM "+DBT+" WHERE filename='"+current_filename+"' LIMIT 1;"
-                        for sub_row in d.execute(query):
-                            resident = sub_row[1]
-                            frags = sub_row[2]
-                            total_sectors = compute_num_sectors(current_filename)
-                            print('\nFilename: '+current_filename)
-                            print('Total Sectors: '+str(total_sectors))
-                            changes = compute_changes(current_filename)
-                            if(OUTPUT_CHANGES_BY_IMAGE):
-                                    show_changes_by_image(current_filename,total_sectors,changes) # disable when running all?
-                            sectors_remaining = plot_persistence(current_filename,resident,frags,total_sectors,changes)
-                            if(OUTPUT_FINAL_PERSISTENCE):
-                                    final_persistence_percent = format((float(sectors_remaining/total_sectors)*100.0), '.2f')
-                                    print('Final Persistence: '+str(final_persistence_percent)+ \
-                                            '% ('+str(sectors_remaining)+'/'+str(total_sectors)+')\n')
-                conn_c.close()
+                analyze_all()
         else: # process one specific file from the DB
-                conn_c = sqlite3.connect(DB)
-                c = conn_c.cursor()
-                #query = "SELECT DISTINCT filename,resident,frags FROM "+DBT+" WHERE filename LIKE '%"+filename+"%';"
-                query = "SELECT DISTINCT filename,resident,frags FROM "+DBT+" WHERE filename='"+filename+"';"
-                #query = "SELECT COUNT(DISTINCT offset) from "+DBT+" WHERE filename LIKE '%"+filename+"%';"
-                for row in c.execute(query):
-                        resident = row[1]
-                        frags = row[2]
-                total_sectors = compute_num_sectors(filename)
-                print('\nFilename: '+filename)
-                print('Total Sectors: '+str(total_sectors))
-                changes = compute_changes(filename)
-                if(OUTPUT_CHANGES_BY_IMAGE):
-                        show_changes_by_image(filename,total_sectors,changes)
-                sectors_remaining = plot_persistence(filename,resident,frags,total_sectors,changes)
-                if(OUTPUT_FINAL_PERSISTENCE):
-                        final_persistence_percent = format((float(sectors_remaining/total_sectors)*100.0), '.2f')
-                        print('Final Persistence: '+str(final_persistence_percent)+ \
-                                '% ('+str(sectors_remaining)+'/'+str(total_sectors)+')\n')
+                cache = None
+                result = None
+                if(USE_CACHE):
+                        cache,fingerprint = open_cache()
+                        result = decay_cache.load_result(cache,filename)
+                if(result is not None): # cached
+                        print('Using cached results from '+CACHE_DB)
+                        outputs = output_files()
+                        if(outputs and decay_cache.outputs_current(cache,fingerprint,outputs)): # written by '*'; this file is in them
+                                print(', '.join(outputs)+' already up to date (all files); not rewritten')
+                                fo_graph,fo_csv = None,None
+                        else:
+                                reset_outputs()
+                                fo_graph,fo_csv = open_outputs()
+                        report_file(result,fo_graph,fo_csv)
+                        if(fo_graph is not None):
+                                fo_graph.close()
+                        if(fo_csv is not None):
+                                fo_csv.close()
+                else:
+                        reset_outputs()
+                        conn_c = sqlite3.connect(DB)
+                        c = conn_c.cursor()
+                        query = "SELECT filename,resident,frags FROM "+DBF+" WHERE filename=?;"
+                        for row in c.execute(query,(filename,)):
+                                resident = row[1]
+                                frags = row[2]
+                        total_sectors = compute_num_sectors(filename)
+                        print('\nFilename: '+filename)
+                        print('Total Sectors: '+str(total_sectors))
+                        changes = compute_changes(filename)
+                        if(OUTPUT_CHANGES_BY_IMAGE):
+                                show_changes_by_image(filename,total_sectors,changes)
+                        sectors_remaining = plot_persistence(filename,resident,frags,total_sectors,changes)
+                        if(OUTPUT_FINAL_PERSISTENCE):
+                                print_final_persistence(sectors_remaining,total_sectors)
+                        if(cache is not None):
+                                R,L,P = compute_persistence(total_sectors,changes)
+                                decay_cache.store_result(cache,(filename,resident,frags,total_sectors,changes,R,P))
+                                cache.commit()
+                if(cache is not None):
+                        cache.close()
+                render_plots()
+        progress.report_stages()
+        progress.stop_profile(profiler)
+        progress.emit('stop',program='trace_file.py')
 
 